@@ -0,0 +1,81 @@
+"""Call an ASGI application in-process, without a server or sockets in between."""
+
+import json
+from typing import Any
+from urllib.parse import urlencode
+
+from starlette.types import ASGIApp, Message
+
+
+class Driver:
+    """Makes requests straight into `app`, so benchmarks measure the application
+    rather than the network stack.
+
+    Usage:
+      >>> driver = Driver(server.application)
+      >>> status, body = await driver.get("/api/get_posts", {"limit": 20}, token)
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def request(
+        self,
+        method: str,
+        path: str,
+        query: dict[str, Any] | None = None,
+        body: Any = None,
+        token: str | None = None,
+    ) -> tuple[int, Any]:
+        """Make a request and return its status and decoded JSON body, `None` if it
+        has no body."""
+        headers = [(b"host", b"bench")]
+        if token is not None:
+            headers.append((b"cookie", f"token={token}".encode()))
+        content = b"" if body is None else json.dumps(body).encode()
+        scope = {
+            "type": "http",
+            "asgi": {"version": "3.0"},
+            "http_version": "1.1",
+            "method": method,
+            "scheme": "http",
+            "path": path,
+            "raw_path": path.encode(),
+            "query_string": urlencode(query or {}).encode(),
+            "root_path": "",
+            "headers": headers,
+            "client": ("127.0.0.1", 0),
+            "server": ("bench", 80),
+        }
+        sent = False
+
+        async def receive() -> Message:
+            nonlocal sent
+            if sent:
+                return {"type": "http.disconnect"}
+            sent = True
+            return {"type": "http.request", "body": content, "more_body": False}
+
+        status = 0
+        chunks: list[bytes] = []
+
+        async def send(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                chunks.append(message.get("body", b""))
+
+        await self.app(scope, receive, send)
+        data = b"".join(chunks)
+        return status, json.loads(data) if data else None
+
+    async def get(
+        self, path: str, query: dict[str, Any] | None = None, token: str | None = None
+    ) -> tuple[int, Any]:
+        return await self.request("GET", path, query=query, token=token)
+
+    async def post(
+        self, path: str, body: Any = None, token: str | None = None
+    ) -> tuple[int, Any]:
+        return await self.request("POST", path, body=body or {}, token=token)
@@ -0,0 +1,86 @@
+"""Measure the per-request overhead of the endpoint decorators in server/misc.py.
+
+Usage:
+  $ python -m benchmarks.endpoint_overhead
+
+The endpoints do no work, so the timings are the cost of parsing and validating
+parameters and building the response.
+"""
+
+import asyncio
+import json
+import time
+from typing import Any
+
+from starlette.requests import Request
+
+from server.main import Main
+from server.misc import RESPONSE, Model
+
+ITERATIONS = 20000
+
+
+class Author(Model):
+    username: str
+    display_name: str
+    permission: int
+
+
+def POST_request(body: dict[str, Any]) -> Request:
+    data = json.dumps(body).encode()
+
+    async def receive() -> dict[str, Any]:
+        return {"type": "http.request", "body": data, "more_body": False}
+
+    return Request({"type": "http", "method": "POST", "headers": []}, receive)
+
+
+def GET_request(query: str) -> Request:
+    return Request(
+        {"type": "http", "method": "GET", "headers": [], "query_string": query.encode()}
+    )
+
+
+async def measure(name: str, endpoint: Any, make_request: Any) -> None:
+    requests = [make_request() for _ in range(ITERATIONS)]
+    start = time.perf_counter()
+    for request in requests:
+        await endpoint(request)
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {elapsed / ITERATIONS * 1e6:.2f} us/request")
+
+
+async def run() -> None:
+    main = Main()
+
+    @main.POST("/post", require_logged_in=False)
+    async def post(
+        request: Request,
+        id: int,
+        content: str | None,
+        tags: list[str],
+        reactions: dict[str, int],
+        author: Author,
+    ) -> RESPONSE:
+        return {}
+
+    @main.GET("/get", require_logged_in=False)
+    async def get(
+        request: Request, id: int, before_id: int | None, limit: int | None
+    ) -> RESPONSE:
+        return {}
+
+    post_endpoint, get_endpoint = (route.endpoint for route in main.routes)
+    body = {
+        "id": 1,
+        "content": "Hello",
+        "tags": [f"tag{i}" for i in range(20)],
+        "reactions": {str(i): i for i in range(20)},
+        "author": {"username": "someone", "display_name": "Someone", "permission": 0},
+    }
+    await measure("POST", post_endpoint, lambda: POST_request(body))
+    await measure("GET", get_endpoint, lambda: GET_request("id=1&limit=20"))
+
+
+if __name__ == "__main__":
+    asyncio.run(run())
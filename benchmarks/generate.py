@@ -0,0 +1,157 @@
+"""Generate a database of synthetic users, posts and reactions.
+
+Usage:
+  $ python -m benchmarks.generate bench.db --users 1000 --posts 20000 --reactions 100000
+
+The same arguments and `--seed` always produce the same users, posts and reactions.
+Every user's password is `PASSWORD`. Tag popularity follows a Zipf distribution, and
+newer posts get more reactions, so the hot paths see roughly the skew production
+does.
+"""
+
+import argparse
+import json
+import os
+import random
+import sqlite3
+import time
+
+PASSWORD = "password"
+TAGS = 50
+# Emojis the client can show, see client/main.ts.
+EMOJIS = 2
+# Fraction of users who can post, and of posts addressed to recipients.
+AUTHORS = 0.1
+DIRECT_POSTS = 0.05
+WORDS = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua enim ad minim veniam quis nostrud "
+    "exercitation ullamco laboris nisi aliquip ex ea commodo consequat"
+).split()
+
+
+def zipf_sample(rng: random.Random, items: list[str], k: int) -> list[str]:
+    """Pick `k` distinct items, earlier ones being more popular."""
+    weights = [1 / (rank + 1) for rank in range(len(items))]
+    picked: set[str] = set()
+    while len(picked) < min(k, len(items)):
+        picked.add(rng.choices(items, weights)[0])
+    return sorted(picked)
+
+
+def generate(
+    database: str,
+    users: int,
+    posts: int,
+    reactions: int,
+    seed: int = 0,
+    inbox: bool = False,
+) -> None:
+    """Create `database` with server/migrations.py and fill it, replacing any
+    existing database there. Pass `inbox` to also fill the inbox for `Main.fanout`."""
+    # Importing server creates the application, let callers choose its database first.
+    from server.migrations import migrate
+    from server.session import hash_password
+
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(database + suffix):
+            os.remove(database + suffix)
+    migrate(database)
+    rng = random.Random(seed)
+    con = sqlite3.connect(database)
+    cur = con.cursor()
+    tags = [f"tag{i}" for i in range(TAGS)]
+    now = int(time.time()) - posts
+    # Hashing is slow on purpose, every user shares one hash of the same password.
+    password_hash = hash_password(PASSWORD)
+    usernames = [f"user{id}" for id in range(1, users + 1)]
+    authors = max(int(users * AUTHORS), 1)
+    cur.executemany(
+        """INSERT INTO user
+           (id, username, password_hash, display_name, tags, permission, created_time)
+           VALUES (?, ?, ?, ?, ?, ?, ?)""",
+        [
+            (
+                id,
+                username,
+                password_hash,
+                f"User {id}",
+                json.dumps(zipf_sample(rng, tags, rng.randint(1, 5))),
+                1 if id <= authors else 0,
+                now,
+            )
+            for id, username in enumerate(usernames, 1)
+        ],
+    )
+    post_rows: list[tuple[int, int, str, str, str, int]] = []
+    post_tags: list[tuple[int, str]] = []
+    post_recipients: list[tuple[int, str]] = []
+    for id in range(1, posts + 1):
+        post_tag_names = zipf_sample(rng, tags, rng.randint(1, 3))
+        recipients = (
+            rng.sample(usernames, min(rng.randint(1, 3), users))
+            if rng.random() < DIRECT_POSTS
+            else []
+        )
+        post_rows.append(
+            (
+                id,
+                rng.randint(1, authors),
+                " ".join(rng.choices(WORDS, k=rng.randint(5, 40))),
+                json.dumps(post_tag_names),
+                json.dumps(recipients),
+                now + id,
+            )
+        )
+        post_tags.extend((id, tag) for tag in post_tag_names)
+        post_recipients.extend((id, username) for username in recipients)
+    cur.executemany(
+        """INSERT INTO post (id, author_id, content, tags, recipients, created_time)
+           VALUES (?, ?, ?, ?, ?, ?)""",
+        post_rows,
+    )
+    cur.executemany("INSERT INTO post_tag (post_id, tag) VALUES (?, ?)", post_tags)
+    cur.executemany(
+        "INSERT INTO post_recipient (post_id, username) VALUES (?, ?)", post_recipients
+    )
+    reaction_rows: set[tuple[int, int, int]] = set()
+    reactions = min(reactions, posts * users * EMOJIS)
+    while len(reaction_rows) < reactions:
+        age = min(int(rng.paretovariate(1.0)) - 1, posts - 1)
+        reaction_rows.add((rng.randrange(EMOJIS), posts - age, rng.randint(1, users)))
+    cur.executemany(
+        "INSERT INTO reaction (emoji, post_id, user_id) VALUES (?, ?, ?)",
+        sorted(reaction_rows),
+    )
+    cur.execute("""INSERT INTO reaction_count (post_id, emoji, count)
+                   SELECT post_id, emoji, COUNT(*) FROM reaction
+                   GROUP BY post_id, emoji""")
+    if inbox:
+        cur.execute("""INSERT OR IGNORE INTO inbox (user_id, post_id)
+                       SELECT u.id, t.post_id
+                       FROM user u, json_each(u.tags) j, post_tag t
+                       WHERE t.tag = j.value
+                       UNION
+                       SELECT u.id, r.post_id FROM user u, post_recipient r
+                       WHERE r.username = u.username""")
+    con.commit()
+    cur.execute("ANALYZE")
+    con.close()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__ and __doc__.splitlines()[0])
+    parser.add_argument("database")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--posts", type=int, default=20000)
+    parser.add_argument("--reactions", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--inbox", action="store_true")
+    args = parser.parse_args()
+    generate(
+        args.database, args.users, args.posts, args.reactions, args.seed, args.inbox
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""Compare ways of encoding a large feed response.
+
+Usage:
+  $ python -m benchmarks.json_encoding
+"""
+
+import json
+import random
+import time
+from typing import Any, Callable
+
+from starlette.responses import JSONResponse
+
+from server.misc import success_response
+
+POSTS = 2000
+ITERATIONS = 20
+
+
+def synthetic_feed(posts: int) -> dict[str, Any]:
+    rng = random.Random(0)
+    return {
+        "posts": [
+            {
+                "id": id,
+                "author": {
+                    "id": rng.randrange(100),
+                    "username": f"user{rng.randrange(100)}",
+                    "display_name": "Some Author",
+                    "avatar_url": None,
+                    "tags": [f"tag{rng.randrange(50)}" for _ in range(3)],
+                    "permission": 1,
+                    "created_time": 1700000000,
+                },
+                "content": "Lorem ipsum dolor sit amet. " * rng.randrange(1, 10),
+                "tags": [f"tag{rng.randrange(50)}" for _ in range(rng.randrange(5))],
+                "recipients": [],
+                "created_time": 1700000000 + id,
+                "reactions": {
+                    rng.randrange(10): (rng.randrange(50), rng.random() < 0.5)
+                    for _ in range(rng.randrange(4))
+                },
+            }
+            for id in range(posts, 0, -1)
+        ],
+        "next": None,
+    }
+
+
+def stdlib_dumps(obj: Any) -> bytes:
+    return json.dumps(
+        obj, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode()
+
+
+def measure(name: str, func: Callable[[], Any]) -> None:
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        func()
+    elapsed = time.perf_counter() - start
+    print(f"{name}: {elapsed / ITERATIONS * 1e3:.2f} ms/response")
+
+
+def run() -> None:
+    response = synthetic_feed(POSTS)
+    print(f"{POSTS} posts, {len(stdlib_dumps(response)) / 1e6:.2f} MB")
+    measure("starlette", lambda: JSONResponse({"success": True, **response}))
+    measure("stdlib", lambda: success_response(stdlib_dumps, response))
+    try:
+        import orjson
+    except ImportError:
+        print("orjson: not installed")
+        return
+    measure(
+        "orjson",
+        lambda: success_response(
+            lambda obj: orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS), response
+        ),
+    )
+
+
+if __name__ == "__main__":
+    run()
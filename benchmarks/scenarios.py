@@ -0,0 +1,159 @@
+"""Load the application with typical traffic and report latency and throughput.
+
+Usage:
+  $ python -m benchmarks.scenarios --users 1000 --posts 20000 --requests 2000
+
+Generates a fresh database with benchmarks/generate.py, then runs each scenario
+against the application in-process and prints a JSON report with the p50, p95 and
+p99 latency in milliseconds and the throughput in requests per second of each.
+Compare reports from before and after a change to catch regressions.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from typing import Any, Awaitable, Callable
+
+from .driver import Driver
+from .generate import EMOJIS, PASSWORD, generate
+
+Request = Callable[[], Awaitable[tuple[int, Any]]]
+
+
+class Scenarios:
+    """The requests each scenario makes, for a set of logged-in users."""
+
+    def __init__(
+        self,
+        driver: Driver,
+        rng: random.Random,
+        users: int,
+        sessions: list[tuple[str, str, list[int]]],
+    ):
+        self.driver = driver
+        self.rng = rng
+        self.users = users
+        # (username, token, ids of posts on the first page of their feed)
+        self.sessions = sessions
+
+    def feed_read(self) -> Awaitable[tuple[int, Any]]:
+        _, token, _ = self.rng.choice(self.sessions)
+        return self.driver.get("/api/get_posts", {}, token)
+
+    def post_read(self) -> Awaitable[tuple[int, Any]]:
+        _, token, feed = self.rng.choice([each for each in self.sessions if each[2]])
+        return self.driver.get("/api/get_post", {"id": self.rng.choice(feed)}, token)
+
+    def reaction_storm(self) -> Awaitable[tuple[int, Any]]:
+        _, token, feed = self.rng.choice([each for each in self.sessions if each[2]])
+        # Everyone piles onto the newest posts they can see.
+        change = {
+            "post_id": self.rng.choice(feed[:20]),
+            "emoji": self.rng.randrange(EMOJIS),
+            "on": self.rng.random() < 0.5,
+        }
+        return self.driver.post("/api/set_reactions", {"changes": [change]}, token)
+
+    def login_burst(self) -> Awaitable[tuple[int, Any]]:
+        username = f"user{self.rng.randint(1, self.users)}"
+        return self.driver.post(
+            "/api/login", {"username": username, "password": PASSWORD}
+        )
+
+
+async def measure(request: Request, requests: int, concurrency: int) -> dict[str, Any]:
+    """Make `requests` requests, `concurrency` at a time."""
+    latencies: list[float] = []
+    errors = 0
+    remaining = requests
+
+    async def worker() -> None:
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            status, body = await request()
+            latencies.append(time.perf_counter() - start)
+            if status != 200 or not body["success"]:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+    return {
+        "requests": requests,
+        "errors": errors,
+        "seconds": round(elapsed, 3),
+        "throughput": round(requests / elapsed, 1),
+        "p50_ms": round(percentiles[49] * 1e3, 3),
+        "p95_ms": round(percentiles[94] * 1e3, 3),
+        "p99_ms": round(percentiles[98] * 1e3, 3),
+    }
+
+
+async def run(args: argparse.Namespace) -> dict[str, Any]:
+    # The application opens its database on import.
+    os.environ["NOTIFYME_DATABASE"] = args.database
+    generate(args.database, args.users, args.posts, args.reactions, args.seed)
+    import server
+
+    driver = Driver(server.application)
+    rng = random.Random(args.seed)
+    report: dict[str, Any] = {"config": vars(args), "scenarios": {}}
+    async with server.main.lifespan(server.application):
+        sessions: list[tuple[str, str, list[int]]] = []
+        for id in rng.sample(range(1, args.users + 1), min(args.sessions, args.users)):
+            username = f"user{id}"
+            _, body = await driver.post(
+                "/api/login", {"username": username, "password": PASSWORD}
+            )
+            _, feed = await driver.get("/api/get_posts", {}, body["token"])
+            sessions.append(
+                (username, body["token"], [post["id"] for post in feed["posts"]])
+            )
+        scenarios = Scenarios(driver, rng, args.users, sessions)
+        for name in args.scenarios:
+            requests = args.requests
+            if name == "login_burst":
+                # Every login hashes a password, which is slow by design.
+                requests = max(requests // 10, 2)
+            print(f"running {name}...", file=sys.stderr)
+            report["scenarios"][name] = await measure(
+                getattr(scenarios, name), requests, args.concurrency
+            )
+    return report
+
+
+SCENARIOS = ("feed_read", "post_read", "reaction_storm", "login_burst")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__ and __doc__.splitlines()[0])
+    parser.add_argument("--database", default="bench.db")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--posts", type=int, default=20000)
+    parser.add_argument("--reactions", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=1000)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument(
+        "--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS)
+    )
+    parser.add_argument("--output", help="Also write the report to this file.")
+    args = parser.parse_args()
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    print(report)
+    if args.output:
+        with open(args.output, "w") as file:
+            file.write(report + "\n")
+
+
+if __name__ == "__main__":
+    main()
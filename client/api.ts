@@ -40,6 +40,21 @@ export async function get(url: string, body: any = {}) {
   return response
 }
 
+export type Call = {
+  method: "GET" | "POST"
+  path: string
+  params?: any
+}
+
+/** Make several calls in one round trip. Each result has its own `success`. */
+export async function batch(calls: Call[]): Promise<any[]> {
+  return (
+    await post("/api/batch", {
+      calls: calls.map((call) => ({ params: {}, ...call })),
+    })
+  ).results
+}
+
 export async function login(username: string, password: string) {
   const token: string = (
     await post("/api/login", { username: username, password: password })
@@ -109,19 +124,72 @@ export async function getUser(username: string): Promise<User> {
   return await get("/api/get_user", { username: username })
 }
 
-export async function deleteUser(password: string) {
-  await post("/api/delete_user", {
-    username: getCookie("username"),
-    password: password,
-  })
+export type Deletion = {
+  posts: number
+  posts_deleted: number
+  reactions: number
+  reactions_deleted: number
+  started_time: number
+  finished_time: number | null
+}
+
+/** Delete the account, returning the token to follow the deletion with. */
+export async function deleteUser(password: string): Promise<string> {
+  return (
+    await post("/api/delete_user", {
+      username: getCookie("username"),
+      password: password,
+    })
+  ).token
+}
+
+export async function getDeletion(token: string): Promise<Deletion> {
+  const response = await get("/api/get_deletion", { token: token })
+  return {
+    posts: response.posts,
+    posts_deleted: response.posts_deleted,
+    reactions: response.reactions,
+    reactions_deleted: response.reactions_deleted,
+    started_time: response.started_time,
+    finished_time: response.finished_time,
+  }
 }
 
 export async function getPost(id: number): Promise<Post> {
   return await get("/api/get_post", { id: id })
 }
 
-export async function getPosts(): Promise<Post[]> {
-  return (await get("/api/get_posts")).posts
+export type PostsPage = {
+  posts: Post[]
+  next: number | null
+}
+
+export async function getPosts(
+  beforeId: number | null = null,
+  limit: number | null = null,
+): Promise<PostsPage> {
+  const params: { [name: string]: string } = {}
+  if (beforeId != null) params.before_id = beforeId.toString()
+  if (limit != null) params.limit = limit.toString()
+  const response = await get("/api/get_posts", params)
+  return { posts: response.posts, next: response.next }
+}
+
+export type SearchPage = {
+  posts: Post[]
+  next: number | null
+}
+
+export async function searchPosts(
+  query: string,
+  offset: number | null = null,
+  limit: number | null = null,
+): Promise<SearchPage> {
+  const params: { [name: string]: string } = { query: query }
+  if (offset != null) params.offset = offset.toString()
+  if (limit != null) params.limit = limit.toString()
+  const response = await get("/api/search_posts", params)
+  return { posts: response.posts, next: response.next }
 }
 
 export async function newPost(
@@ -167,3 +235,51 @@ export async function addReaction(postId: number, emoji: number) {
 export async function removeReaction(postId: number, emoji: number) {
   await post("/api/remove_reaction", { post_id: postId, emoji: emoji })
 }
+
+export type ReactionChange = {
+  post_id: number
+  emoji: number
+  on: boolean
+}
+
+export async function setReactions(changes: ReactionChange[]) {
+  await post("/api/set_reactions", { changes: changes })
+}
+
+export type FeedEvent =
+  | "post_created"
+  | "post_edited"
+  | "post_deleted"
+  | "reaction_changed"
+  | "resync"
+
+/** A post as events carry it, with only the count of each emoji. */
+export type EventPost = Omit<Post, "reactions"> & {
+  reactions: { [index: number]: number }
+}
+
+export type FeedEventData = {
+  id?: number
+  /** With `post_created` and `post_edited`. */
+  post?: EventPost | null
+  /** With `reaction_changed`, the new count of each emoji. */
+  reactions?: { [index: number]: number }
+}
+
+export function subscribe(
+  onEvent: (event: FeedEvent, data: FeedEventData) => void,
+): EventSource {
+  const source = new EventSource("/api/events")
+  for (const event of [
+    "post_created",
+    "post_edited",
+    "post_deleted",
+    "reaction_changed",
+    "resync",
+  ] as FeedEvent[]) {
+    source.addEventListener(event, (message) => {
+      onEvent(event, JSON.parse((message as MessageEvent).data))
+    })
+  }
+  return source
+}
@@ -515,16 +515,80 @@ function newPost(post: api.Post) {
   return container
 }
 
+let feedEvents: EventSource | undefined
+
 async function homepage() {
   document.title = "notifyme - Home"
-  const posts = await api.getPosts()
-  app.replaceChildren(
-    headerBar(),
-    gtk.newColumn({ cls: "pad-1 gap-1" }, ...posts.map(newPost)),
-  )
+  const page = await api.getPosts()
+  const elements = new Map<number, HTMLElement>()
+  const posts = new Map<number, api.Post>()
+  const render = (post: api.Post) => {
+    const element = newPost(post)
+    elements.set(post.id, element)
+    posts.set(post.id, post)
+    return element
+  }
+  // Events only carry counts, keep our own reactions from the post we have.
+  const withOwnReactions = (
+    counts: { [index: number]: number },
+    old: api.Post | undefined,
+  ): api.Post["reactions"] =>
+    Object.fromEntries(
+      Object.entries(counts).map(
+        ([emoji, count]): [string, [number, boolean]] => [
+          emoji,
+          [count, old?.reactions[Number(emoji)]?.[1] ?? false],
+        ],
+      ),
+    )
+  const feed = gtk.newColumn({ cls: "pad-1 gap-1" }, ...page.posts.map(render))
+  let next = page.next
+  const loadMoreButton = gtk.newButton("Load more", {
+    cls: "button-primary",
+    onclick: async () => {
+      if (next == null) return
+      const page = await api.getPosts(next)
+      next = page.next
+      loadMoreButton.before(...page.posts.map(render))
+      if (next == null) loadMoreButton.remove()
+    },
+  })
+  if (next != null) feed.append(loadMoreButton)
+  app.replaceChildren(headerBar(), feed)
+  feedEvents?.close()
+  feedEvents = api.subscribe(async (event, data) => {
+    if (event == "resync") {
+      await homepage()
+      return
+    }
+    if (data.id == undefined) return
+    const element = elements.get(data.id)
+    const old = posts.get(data.id)
+    if (event == "post_deleted") {
+      element?.remove()
+      elements.delete(data.id)
+      posts.delete(data.id)
+      return
+    }
+    let post: api.Post
+    if (event == "reaction_changed") {
+      if (old == undefined || data.reactions == undefined) return
+      post = { ...old, reactions: withOwnReactions(data.reactions, old) }
+    } else {
+      if (data.post == undefined) return
+      post = {
+        ...data.post,
+        reactions: withOwnReactions(data.post.reactions, old),
+      }
+    }
+    if (element) element.replaceWith(render(post))
+    else if (event == "post_created") feed.prepend(render(post))
+  })
 }
 
 async function loadView() {
+  feedEvents?.close()
+  feedEvents = undefined
   const path = window.location.pathname.split("/")
   if (path.length == 2 && path[1] == "login") {
     if (await api.isLoggedIn()) {
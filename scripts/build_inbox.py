@@ -0,0 +1,23 @@
+"""Fill the inbox table, run this before enabling `Main.fanout` on an existing
+database."""
+
+import os
+import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.migrations import migrate  # noqa: E402
+
+database = "database.db"
+migrate(database)
+con = sqlite3.connect(database)
+cur = con.cursor()
+cur.execute("DELETE FROM inbox")
+cur.execute("""INSERT OR IGNORE INTO inbox (user_id, post_id)
+               SELECT u.id, t.post_id FROM user u, json_each(u.tags) j, post_tag t
+               WHERE t.tag = j.value
+               UNION
+               SELECT u.id, r.post_id FROM user u, post_recipient r
+               WHERE r.username = u.username""")
+con.commit()
@@ -1,9 +1,12 @@
+"""Create the database, or upgrade an existing one in place, by applying the
+migrations of server/migrations.py it doesn't have yet."""
+
 import os
-import sqlite3
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from server.migrations import migrate  # noqa: E402
 
 database = "database.db"
-os.remove(database)
-con = sqlite3.connect(database)
-cur = con.cursor()
-cur.executescript(open("server/schema.sql").read())
-con.commit()
+print(f"Applied {migrate(database)} migrations to {database}.")
@@ -2,8 +2,11 @@ from .main import Main
 
 main = Main()
 
+from . import batch as _
+from . import deletion as _
 from . import post as _
 from . import reaction as _
+from . import search as _
 from . import user as _
 
 application = main.create_starlette_application()
@@ -0,0 +1,39 @@
+from typing import Any
+
+from starlette.requests import Request
+
+from . import main
+from .misc import RESPONSE, Error, Model
+
+# Most calls a single /api/batch request may make.
+BATCH_SIZE_MAX = 100
+
+
+class Call(Model):
+    method: str
+    path: str
+    params: dict[str, Any]
+
+
+@main.POST("/api/batch", require_logged_in=False)
+async def batch(request: Request, calls: list[Call]) -> RESPONSE:
+    """Make several endpoint calls in one round trip.
+
+    The calls are made in order, in-process, sharing one session lookup. Each result
+    is what that endpoint would have responded with on its own, so one call failing
+    doesn't stop the ones after it.
+    """
+    if len(calls) > BATCH_SIZE_MAX:
+        raise Error(f"A batch can make at most {BATCH_SIZE_MAX} calls.")
+    session = await main.sessions.get_session(request)
+    results: list[RESPONSE] = []
+    for call in calls:
+        endpoint = main.endpoints.get((call.method.upper(), call.path))
+        try:
+            if endpoint is None or call.path == "/api/batch":
+                raise Error(f"No endpoint {call.method} {call.path}.")
+            response = await endpoint(request, session, call.params)
+            results.append({"success": True, **response})
+        except Error as err:
+            results.append({"success": False, "error": err.args[0]})
+    return {"results": results}
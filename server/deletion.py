@@ -0,0 +1,267 @@
+"""Account deletion, which removes what a user made in the background.
+
+`start_deletion` only marks the user as deleted, which hides them and their posts at
+once. `deletion_worker` then removes, one write of at most `DELETION_CHUNK` rows at a
+time so other writes are never held up for long:
+
+1. the reactions on the user's posts and those posts' inbox rows,
+2. the user's posts, with their tags, recipients and reaction counts,
+3. the user's own reactions, taking them out of the counts,
+4. the user's inbox, then the user and whatever is left of their sessions.
+
+Progress is kept in the `user_deletion` table, so deletions interrupted by a restart
+resume, and is reported by /api/get_deletion. The username stays taken until the
+deletion finishes.
+"""
+
+import asyncio
+import json
+import secrets
+import sqlite3
+import traceback
+from typing import Any
+
+from starlette.requests import Request
+
+from . import main
+from .misc import RESPONSE, Error
+from .post import get_reaction_counts
+from .reaction import count_reaction
+from .versions import next_version, touch_author_tags, touch_post, touch_tags
+
+# Most rows removed by one write.
+DELETION_CHUNK = 500
+# Seconds between checks for deletions started by other workers or left to retry.
+DELETION_POLL_INTERVAL = 60
+
+# Set when a deletion is started, to wake `deletion_worker`.
+deletion_started = asyncio.Event()
+
+# An event to publish about a post once a chunk is committed, as
+# `(type, data, tags, recipients)`.
+PostEvent = tuple[str, dict[str, Any], list[str], list[str]]
+
+
+async def start_deletion(user_id: int) -> str:
+    """Mark a user as deleted and queue the removal of everything they made. Return
+    the token /api/get_deletion takes."""
+    token = secrets.token_urlsafe()
+
+    def write(cur: sqlite3.Cursor) -> list[str]:
+        cur.execute(
+            """UPDATE user SET deleted_time = unixepoch()
+               WHERE id = ? AND deleted_time IS NULL""",
+            [user_id],
+        )
+        if cur.rowcount == 0:
+            raise Error("Username not found.")
+        cur.execute(
+            """INSERT INTO user_deletion (token, user_id, posts, reactions)
+               VALUES (
+                   ?,
+                   ?,
+                   (SELECT COUNT(*) FROM post WHERE author_id = ?),
+                   (
+                       SELECT COUNT(*) FROM reaction r, post p
+                       WHERE r.user_id = ? AND p.id = r.post_id AND p.author_id != ?
+                   )
+               )""",
+            [token, user_id, user_id, user_id, user_id],
+        )
+        # Feeds no longer show the user's posts.
+        next_version(cur)
+        return touch_author_tags(cur, user_id)
+
+    main.feed_cache.invalidate(await main.write(write))
+    deletion_started.set()
+    return token
+
+
+def get_audiences(
+    cur: sqlite3.Cursor, post_ids: list[int]
+) -> dict[int, tuple[list[str], list[str]]]:
+    """Fetch the tags and recipients of many posts in two queries."""
+    audiences: dict[int, tuple[list[str], list[str]]] = {
+        post_id: ([], []) for post_id in post_ids
+    }
+    ids = json.dumps(post_ids)
+    for row in cur.execute(
+        """SELECT post_id, tag FROM post_tag
+           WHERE post_id IN (SELECT value FROM json_each(?))""",
+        [ids],
+    ):
+        audiences[row["post_id"]][0].append(row["tag"])
+    for row in cur.execute(
+        """SELECT post_id, username FROM post_recipient
+           WHERE post_id IN (SELECT value FROM json_each(?))""",
+        [ids],
+    ):
+        audiences[row["post_id"]][1].append(row["username"])
+    return audiences
+
+
+def delete_chunk(
+    cur: sqlite3.Cursor, token: str, user_id: int
+) -> list[PostEvent] | None:
+    """Remove the next chunk of a deleted user's data. Return the events to publish,
+    or finish the deletion and return `None` once nothing else is left."""
+    # The posts are hidden already, so the counts of these reactions can go with
+    # the posts.
+    cur.execute(
+        """DELETE FROM reaction WHERE id IN (
+               SELECT r.id FROM post p, reaction r
+               WHERE p.author_id = ? AND r.post_id = p.id
+               LIMIT ?
+           )""",
+        [user_id, DELETION_CHUNK],
+    )
+    if cur.rowcount > 0:
+        return []
+    cur.execute(
+        """DELETE FROM inbox WHERE (user_id, post_id) IN (
+               SELECT i.user_id, i.post_id FROM post p, inbox i
+               WHERE p.author_id = ? AND i.post_id = p.id
+               LIMIT ?
+           )""",
+        [user_id, DELETION_CHUNK],
+    )
+    if cur.rowcount > 0:
+        return []
+
+    post_ids = [
+        row["id"]
+        for row in cur.execute(
+            "SELECT id FROM post WHERE author_id = ? LIMIT ?",
+            [user_id, DELETION_CHUNK],
+        )
+    ]
+    if post_ids:
+        audiences = get_audiences(cur, post_ids)
+        ids = json.dumps(post_ids)
+        # Reactions and inbox rows may have been added since they were removed.
+        for table in (
+            "reaction",
+            "inbox",
+            "post_tag",
+            "post_recipient",
+            "reaction_count",
+        ):
+            cur.execute(
+                f"""DELETE FROM {table}
+                    WHERE post_id IN (SELECT value FROM json_each(?))""",
+                [ids],
+            )
+        cur.execute(
+            "DELETE FROM post WHERE id IN (SELECT value FROM json_each(?))", [ids]
+        )
+        cur.execute(
+            """UPDATE user_deletion SET posts_deleted = posts_deleted + ?
+               WHERE token = ?""",
+            [len(post_ids), token],
+        )
+        next_version(cur)
+        touch_tags(cur, [tag for tags, _ in audiences.values() for tag in tags])
+        return [("post_deleted", {"id": id}, *audiences[id]) for id in post_ids]
+
+    reactions = cur.execute(
+        "SELECT id, post_id, emoji FROM reaction WHERE user_id = ? LIMIT ?",
+        [user_id, DELETION_CHUNK],
+    ).fetchall()
+    if reactions:
+        cur.execute(
+            "DELETE FROM reaction WHERE id IN (SELECT value FROM json_each(?))",
+            [json.dumps([row["id"] for row in reactions])],
+        )
+        for row in reactions:
+            count_reaction(cur, row["post_id"], row["emoji"], -1)
+        post_ids = sorted({row["post_id"] for row in reactions})
+        for post_id in post_ids:
+            touch_post(cur, post_id)
+        cur.execute(
+            """UPDATE user_deletion SET reactions_deleted = reactions_deleted + ?
+               WHERE token = ?""",
+            [len(reactions), token],
+        )
+        audiences = get_audiences(cur, post_ids)
+        touch_tags(cur, [tag for tags, _ in audiences.values() for tag in tags])
+        counts = get_reaction_counts(cur, post_ids)
+        return [
+            (
+                "reaction_changed",
+                {"id": id, "reactions": counts.get(id, {})},
+                *audiences[id],
+            )
+            for id in post_ids
+        ]
+
+    cur.execute(
+        """DELETE FROM inbox WHERE (user_id, post_id) IN (
+               SELECT user_id, post_id FROM inbox WHERE user_id = ? LIMIT ?
+           )""",
+        [user_id, DELETION_CHUNK],
+    )
+    if cur.rowcount > 0:
+        return []
+
+    cur.execute("DELETE FROM session WHERE user_id = ?", [user_id])
+    cur.execute("DELETE FROM user WHERE id = ?", [user_id])
+    cur.execute(
+        "UPDATE user_deletion SET finished_time = unixepoch() WHERE token = ?",
+        [token],
+    )
+    return None
+
+
+async def run_deletion(token: str, user_id: int) -> None:
+    while True:
+        events = await main.write(lambda cur: delete_chunk(cur, token, user_id))
+        if events is None:
+            return
+        main.feed_cache.invalidate([tag for _, _, tags, _ in events for tag in tags])
+        for type, data, tags, recipients in events:
+            main.events.publish(type, data, tags, recipients)
+
+
+async def deletion_worker() -> None:
+    """Carry out unfinished deletions, runs for the lifetime of the app."""
+    while True:
+        deletion_started.clear()
+        try:
+            for row in await main.fetchall(
+                """SELECT token, user_id FROM user_deletion
+                   WHERE finished_time IS NULL ORDER BY started_time""",
+                [],
+            ):
+                await run_deletion(row["token"], row["user_id"])
+        except Exception:
+            # Left unfinished, so it is retried at the next poll.
+            traceback.print_exc()
+        try:
+            await asyncio.wait_for(deletion_started.wait(), DELETION_POLL_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+
+
+main.workers.append(deletion_worker)
+
+
+@main.GET("/api/get_deletion", require_logged_in=False)
+async def get_deletion(request: Request, token: str) -> RESPONSE:
+    """Report how far the deletion started by /api/delete_user has got. `posts` and
+    `reactions` are how many posts and reactions to other users' posts the user had
+    when it started."""
+    row = await main.fetchone(
+        """SELECT posts, posts_deleted, reactions, reactions_deleted, started_time,
+           finished_time FROM user_deletion WHERE token = ?""",
+        [token],
+    )
+    if row is None:
+        raise Error("Deletion not found.")
+    return {
+        "posts": row["posts"],
+        "posts_deleted": row["posts_deleted"],
+        "reactions": row["reactions"],
+        "reactions_deleted": row["reactions_deleted"],
+        "started_time": row["started_time"],
+        "finished_time": row["finished_time"],
+    }
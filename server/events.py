@@ -0,0 +1,107 @@
+"""In-process publish/subscribe of post and reaction changes, streamed to clients
+as Server-Sent Events by `Main.event_stream`."""
+
+import asyncio
+from typing import Any, TypeVar
+
+from .session import Session
+
+# An event is (type, data), e.g. ("post_deleted", {"id": 1}).
+Event = tuple[str, dict[str, Any]]
+
+K = TypeVar("K")
+
+
+class Subscriber:
+    def __init__(self, session: Session, size: int) -> None:
+        self.session = session
+        self.tags = set(session.tags)
+        # `None` ends the stream.
+        self.queue: asyncio.Queue[Event | None] = asyncio.Queue(size)
+
+    def send(self, event: Event) -> None:
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # The client fell behind, drop what it missed and make it reload.
+            while not self.queue.empty():
+                self.queue.get_nowait()
+            self.queue.put_nowait(("resync", {}))
+
+    def close(self) -> None:
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.queue.put_nowait(None)
+
+
+def discard(index: dict[K, set[Subscriber]], key: K, subscriber: Subscriber) -> None:
+    subscribers = index.get(key)
+    if subscribers is None:
+        return
+    subscribers.discard(subscriber)
+    if not subscribers:
+        del index[key]
+
+
+class EventHub:
+    """Delivers each event only to subscribers whose session can see the post.
+
+    Subscribers are indexed by tag and by username, so publishing costs time
+    proportional to the matching subscribers, not to all of them, and by user id so
+    their streams can be closed when their sessions end.
+    """
+
+    def __init__(self, queue_size: int = 64) -> None:
+        self.queue_size = queue_size
+        self.by_tag: dict[str, set[Subscriber]] = {}
+        self.by_username: dict[str, set[Subscriber]] = {}
+        self.by_user_id: dict[int, set[Subscriber]] = {}
+
+    def subscribe(self, session: Session) -> Subscriber:
+        subscriber = Subscriber(session, self.queue_size)
+        self.index(subscriber)
+        return subscriber
+
+    def unsubscribe(self, subscriber: Subscriber) -> None:
+        self.unindex(subscriber)
+
+    def index(self, subscriber: Subscriber) -> None:
+        for tag in subscriber.tags:
+            self.by_tag.setdefault(tag, set()).add(subscriber)
+        self.by_username.setdefault(subscriber.session.username, set()).add(subscriber)
+        self.by_user_id.setdefault(subscriber.session.user_id, set()).add(subscriber)
+
+    def unindex(self, subscriber: Subscriber) -> None:
+        for tag in subscriber.tags:
+            discard(self.by_tag, tag, subscriber)
+        discard(self.by_username, subscriber.session.username, subscriber)
+        discard(self.by_user_id, subscriber.session.user_id, subscriber)
+
+    def update_tags(self, username: str, tags: list[str]) -> None:
+        """Re-index a user's subscribers after their tags changed."""
+        for subscriber in list(self.by_username.get(username, ())):
+            self.unindex(subscriber)
+            subscriber.tags = set(tags)
+            self.index(subscriber)
+
+    def close(self, user_id: int, token: str | None = None) -> None:
+        """End the streams of a user's sessions, or only of the session `token`."""
+        for subscriber in list(self.by_user_id.get(user_id, ())):
+            if token is None or subscriber.session.token == token:
+                self.unindex(subscriber)
+                subscriber.close()
+
+    def subscribers(self, tags: list[str], recipients: list[str]) -> set[Subscriber]:
+        """Return the subscribers who can see a post with `tags` and `recipients`."""
+        subscribers: set[Subscriber] = set()
+        for tag in tags:
+            subscribers.update(self.by_tag.get(tag, ()))
+        for username in recipients:
+            subscribers.update(self.by_username.get(username, ()))
+        return subscribers
+
+    def publish(
+        self, type: str, data: dict[str, Any], tags: list[str], recipients: list[str]
+    ) -> None:
+        for subscriber in self.subscribers(tags, recipients):
+            subscriber.send((type, data))
@@ -0,0 +1,84 @@
+from collections import OrderedDict
+from typing import Any, Iterable
+
+# (sorted subscribed tags, before_id, limit)
+FeedKey = tuple[tuple[str, ...], int | None, int]
+
+
+class FeedCache:
+    """An LRU cache of feed pages built from tag subscriptions alone.
+
+    Users subscribed to the same set of tags share pages, posts sent to them as a
+    recipient are merged in per request. Writes invalidate the pages of the tags
+    they touch.
+
+    Each page is kept with the versions of its tags (see server/versions.py) read
+    before building it, and is a miss once any of them has moved on, so writes made
+    by other worker processes are never missed.
+    """
+
+    def __init__(self, size: int = 1024) -> None:
+        self.size = size
+        self.pages: OrderedDict[FeedKey, tuple[tuple[int, ...], list[Any]]] = (
+            OrderedDict()
+        )
+        self.tag_keys: dict[str, set[FeedKey]] = {}
+        # Bumped on every invalidation, so a page read before a write can't be
+        # stored after it.
+        self.version = 0
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(tags: list[str], before_id: int | None, limit: int) -> FeedKey:
+        return tuple(sorted(set(tags))), before_id, limit
+
+    def get(self, key: FeedKey, versions: tuple[int, ...]) -> list[Any] | None:
+        page = self.pages.get(key)
+        if page is None or page[0] != versions:
+            self.misses += 1
+            if page is not None:
+                self.remove(key)
+            return None
+        self.hits += 1
+        self.pages.move_to_end(key)
+        return page[1]
+
+    def put(
+        self,
+        key: FeedKey,
+        posts: list[Any],
+        version: int,
+        versions: tuple[int, ...],
+    ) -> None:
+        if version != self.version:
+            return
+        self.pages[key] = (versions, posts)
+        self.pages.move_to_end(key)
+        for tag in key[0]:
+            self.tag_keys.setdefault(tag, set()).add(key)
+        if len(self.pages) > self.size:
+            self.remove(next(iter(self.pages)))
+
+    def remove(self, key: FeedKey) -> None:
+        if self.pages.pop(key, None) is None:
+            return
+        for tag in key[0]:
+            keys = self.tag_keys[tag]
+            keys.discard(key)
+            if not keys:
+                del self.tag_keys[tag]
+
+    def invalidate(self, tags: Iterable[str]) -> None:
+        self.version += 1
+        for tag in tags:
+            for key in list(self.tag_keys.get(tag, ())):
+                self.remove(key)
+
+    def clear(self) -> None:
+        self.version += 1
+        self.pages.clear()
+        self.tag_keys.clear()
+
+    def stats(self) -> dict[str, int]:
+        return {"size": len(self.pages), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,38 @@
+"""Fan-out-on-write inbox, used when `Main.fanout` is enabled.
+
+Every post is written into the inbox of each user who can see it, so reading a
+feed is a range scan over that user's inbox rows.
+"""
+
+import sqlite3
+
+
+def fan_out_post(cur: sqlite3.Cursor, post_id: int) -> None:
+    cur.execute("DELETE FROM inbox WHERE post_id = ?", [post_id])
+    cur.execute(
+        """INSERT OR IGNORE INTO inbox (user_id, post_id)
+           SELECT u.id, ? FROM user u
+           WHERE EXISTS (
+               SELECT 1 FROM json_each(u.tags)
+               WHERE value IN (SELECT tag FROM post_tag WHERE post_id = ?)
+           )
+           UNION
+           SELECT u.id, ? FROM user u, post_recipient r
+           WHERE r.post_id = ? AND u.username = r.username""",
+        [post_id, post_id, post_id, post_id],
+    )
+
+
+def rebuild_inbox(cur: sqlite3.Cursor, user_id: int) -> None:
+    cur.execute("DELETE FROM inbox WHERE user_id = ?", [user_id])
+    cur.execute(
+        """INSERT OR IGNORE INTO inbox (user_id, post_id)
+           SELECT ?, post_id FROM post_tag
+           WHERE tag IN (
+               SELECT value FROM json_each((SELECT tags FROM user WHERE id = ?))
+           )
+           UNION
+           SELECT ?, post_id FROM post_recipient
+           WHERE username = (SELECT username FROM user WHERE id = ?)""",
+        [user_id, user_id, user_id, user_id],
+    )
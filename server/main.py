@@ -1,21 +1,119 @@
+import asyncio
+import contextvars
+import functools
+import hmac
+import os
 import sqlite3
-from typing import Any
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
+from typing import (
+    Any,
+    AsyncGenerator,
+    AsyncIterator,
+    Callable,
+    Coroutine,
+    Generator,
+    TypeVar,
+)
 
 from starlette.applications import Starlette
+from starlette.middleware import Middleware
 from starlette.requests import Request
-from starlette.responses import FileResponse
+from starlette.responses import (
+    FileResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
 from starlette.routing import Mount, Route
 from starlette.staticfiles import StaticFiles
 
-from .misc import GET_endpoint_decorator, POST_endpoint_decorator
-from .session import Sessions
+from .events import EventHub
+from .feedcache import FeedCache
+from .metrics import InstrumentedCursor, Metrics
+from .migrations import migrate
+from .misc import (
+    EndpointCall,
+    ETagFunction,
+    Error,
+    GET_endpoint_decorator,
+    POST_endpoint_decorator,
+    authorize,
+    json_dumps,
+    json_loads,
+)
+from .pool import ConnectionPool
+from .profiler import Profiler
+from .session import MemorySessionBackend, Sessions, SQLiteSessionBackend
+
+T = TypeVar("T")
+
+# Seconds between keepalive comments on idle event streams.
+EVENT_KEEPALIVE = 15
+# Seconds writes are collected for before being committed together, and the most
+# writes committed in one transaction.
+WRITE_BATCH_WINDOW = 0.002
+WRITE_BATCH_MAX = 256
+
+WriteJob = tuple[Callable[[sqlite3.Cursor], Any], "asyncio.Future[Any]"]
+
+
+class WriteFailed:
+    """Marks a write in a batch which raised `error`."""
+
+    def __init__(self, error: Exception):
+        self.error = error
 
 
 class Main:
     def __init__(self):
-        self.database = "database.db"
+        self.database = os.environ.get("NOTIFYME_DATABASE", "database.db")
+        # Write posts into each subscriber's inbox so feeds are read from there.
+        # Run scripts/build_inbox.py before enabling this on an existing database.
+        self.fanout = False
+        self.pool = ConnectionPool(self.database)
+        self.feed_cache = FeedCache()
+        self.events = EventHub()
+        self.metrics = Metrics()
+        # /api/metrics includes every SQL statement run, so only sessions with
+        # permission 1 may read it, and scrapers which send this token as
+        # `Authorization: Bearer <token>`.
+        self.metrics_token = os.environ.get("NOTIFYME_METRICS_TOKEN")
+        # Trace this fraction of API requests with cProfile, and any API request
+        # slower than `profile_slow_threshold` seconds with stack samples, keeping the
+        # newest `profile_ring_size` traces in `profile_directory`. See
+        # server/profiler.py, both are off by default.
+        self.profile_rate = 0.0
+        self.profile_slow_threshold: float | None = None
+        self.profile_directory = "profiles"
+        self.profile_ring_size = 100
+        # One pooled connection is always left for the writer lane.
+        self.readers = ThreadPoolExecutor(self.pool.size - 1, "db-reader")
+        self.writer = ThreadPoolExecutor(1, "db-writer")
+        # Writes waiting for the next group commit, see `write`.
+        self.write_jobs: list[WriteJob] = []
+        self.write_task: asyncio.Task[None] | None = None
+        # Caps how many passwords are hashed at once, so a login storm can't starve
+        # everything else of CPU.
+        self.hashers = ThreadPoolExecutor(2, "password-hasher")
         self.routes: list[Route] = []
-        self.sessions = Sessions(self)
+        # Endpoints by `(method, path)`, for calling them in-process from /api/batch.
+        self.endpoints: dict[tuple[str, str], EndpointCall] = {}
+        # Used by the endpoints to decode requests and encode responses, orjson when
+        # it is installed and the standard library otherwise.
+        self.json_dumps: Callable[[Any], bytes] = json_dumps
+        self.json_loads: Callable[[bytes], Any] = json_loads
+        # "sqlite" keeps sessions in the database, shared between workers and kept
+        # across restarts, "memory" keeps them in this process only.
+        sessions = os.environ.get("NOTIFYME_SESSIONS", "memory")
+        if sessions == "sqlite":
+            self.sessions = Sessions(self, SQLiteSessionBackend(self))
+        elif sessions == "memory":
+            self.sessions = Sessions(self, MemorySessionBackend())
+        else:
+            raise ValueError(f"Unknown NOTIFYME_SESSIONS {sessions}")
+        # Coroutine functions run as tasks for the lifetime of the app.
+        self.workers: list[Callable[[], Coroutine[Any, Any, None]]] = []
 
     def POST(
         self,
@@ -46,6 +144,7 @@ class Main:
         path: str,
         require_logged_in: bool = True,
         permissions: tuple[int, ...] = (),
+        etag: ETagFunction | None = None,
     ):
         """Define a GET endpoint which takes in query parameters and returns JSON.
 
@@ -62,34 +161,224 @@ class Main:
 
         Raising a `Error` will respond with
           >>> {"success": False, "error": "Error message here..."}
+
+        If `etag` is given, it is called with the same arguments as the endpoint and
+        should cheaply return a string which changes whenever the response would.
+        Requests whose `If-None-Match` matches it get a `304 Not Modified` without
+        the endpoint being called.
         """
-        return GET_endpoint_decorator(self, path, require_logged_in, permissions)
+        return GET_endpoint_decorator(self, path, require_logged_in, permissions, etag)
 
     def application_route(self, request: Request) -> FileResponse:
         return FileResponse("client/app.html")
 
-    def db(self):
-        con = sqlite3.connect(self.database)
-        con.row_factory = sqlite3.Row
-        return con, con.cursor()
+    async def event_stream(self, request: Request) -> Response:
+        """Stream changes to posts the session can see as Server-Sent Events.
+
+        Events are `post_created`, `post_edited`, `post_deleted` and
+        `reaction_changed`, each with the post's `id`. `post_created` and
+        `post_edited` also have the `post`, as `read_posts` returns it, and
+        `reaction_changed` its new count of each emoji as `reactions`, so clients
+        don't need to fetch them. A `resync` event means some events were dropped
+        and the client should reload its feed. The stream ends with the session.
+        """
+        session = await self.sessions.get_session(request)
+        if session is None:
+            return Error(
+                "This API endpoint requires you to be logged in."
+            ).to_JSONResponse(self.json_dumps)
+        subscriber = self.events.subscribe(session)
+
+        async def stream() -> AsyncIterator[bytes]:
+            try:
+                while True:
+                    try:
+                        event = await asyncio.wait_for(
+                            subscriber.queue.get(), EVENT_KEEPALIVE
+                        )
+                    except asyncio.TimeoutError:
+                        # Sessions can also expire, or be removed by another worker.
+                        if await self.sessions.get_session(request) is None:
+                            return
+                        yield b": keepalive\n\n"
+                        continue
+                    if event is None:
+                        # The session was removed.
+                        return
+                    type, data = event
+                    yield (
+                        f"event: {type}\ndata: ".encode()
+                        + self.json_dumps(data)
+                        + b"\n\n"
+                    )
+            finally:
+                self.events.unsubscribe(subscriber)
+
+        return StreamingResponse(
+            stream(),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache"},
+        )
+
+    async def metrics_endpoint(self, request: Request) -> Response:
+        """Report request, SQL and feed cache metrics in the Prometheus text
+        format."""
+        if self.metrics_token is None or not hmac.compare_digest(
+            request.headers.get("authorization", ""), f"Bearer {self.metrics_token}"
+        ):
+            try:
+                authorize(await self.sessions.get_session(request), (1,))
+            except Error as e:
+                return e.to_JSONResponse(self.json_dumps)
+        stats = self.feed_cache.stats()
+        counters = {
+            "notifyme_feed_cache_hits_total": stats["hits"],
+            "notifyme_feed_cache_misses_total": stats["misses"],
+        }
+        gauges = {
+            "notifyme_feed_cache_size": stats["size"],
+            "notifyme_event_subscribers": sum(
+                len(subscribers) for subscribers in self.events.by_username.values()
+            ),
+        }
+        return PlainTextResponse(
+            self.metrics.render(counters, gauges),
+            media_type="text/plain; version=0.0.4",
+        )
+
+    @contextmanager
+    def db(self) -> Generator[tuple[sqlite3.Connection, sqlite3.Cursor], None, None]:
+        """Borrow a connection from the pool for the duration of a `with` block.
+
+        Usage:
+          >>> with main.db() as (con, cur):
+          ...     cur.execute(...)
+          ...     con.commit()
+
+        Anything not committed by the end of the block is rolled back.
+        """
+        with self.pool.connection() as con:
+            yield con, con.cursor(
+                functools.partial(InstrumentedCursor, metrics=self.metrics)
+            )
+
+    async def read(self, func: Callable[[sqlite3.Cursor], T]) -> T:
+        """Run `func` with a pooled cursor on the reader thread pool.
+
+        Usage:
+          >>> rows = await main.read(lambda cur: cur.execute(...).fetchall())
+        """
+
+        def job() -> T:
+            with self.db() as (_, cur):
+                return func(cur)
+
+        # Run in this context so the queries count towards the current request.
+        return await asyncio.get_running_loop().run_in_executor(
+            self.readers, contextvars.copy_context().run, job
+        )
+
+    async def write(self, func: Callable[[sqlite3.Cursor], T]) -> T:
+        """Run `func` with a pooled cursor on the single writer thread, then commit.
 
-    def db_fetchone(self, query: str, params: list[Any]) -> dict[str, Any] | None:
-        con, cur = self.db()
-        row = cur.execute(query, params).fetchone()
-        con.close()
-        return row
+        All writes go through this one lane so they never contend for SQLite's write
+        lock. Writes made within `WRITE_BATCH_WINDOW` seconds of each other are
+        committed together in one transaction, each in its own savepoint, so raising
+        inside `func` only rolls back what `func` did.
+        """
+        future: asyncio.Future[T] = asyncio.get_running_loop().create_future()
+        context = contextvars.copy_context()
+        self.write_jobs.append((lambda cur: context.run(func, cur), future))
+        if self.write_task is None:
+            self.write_task = asyncio.create_task(self.write_batches())
+        return await future
+
+    async def write_batches(self) -> None:
+        """Commit the queued writes in batches until there are none left."""
+        loop = asyncio.get_running_loop()
+        try:
+            while self.write_jobs:
+                await asyncio.sleep(WRITE_BATCH_WINDOW)
+                jobs = self.write_jobs[:WRITE_BATCH_MAX]
+                del self.write_jobs[:WRITE_BATCH_MAX]
+                outcomes: list[Any]
+                try:
+                    outcomes = await loop.run_in_executor(
+                        self.writer, self.write_batch, [func for func, _ in jobs]
+                    )
+                except Exception as e:
+                    # The commit itself failed, so none of the writes happened.
+                    outcomes = [WriteFailed(e)] * len(jobs)
+                for (_, future), outcome in zip(jobs, outcomes):
+                    if future.done():
+                        continue
+                    if isinstance(outcome, WriteFailed):
+                        future.set_exception(outcome.error)
+                    else:
+                        future.set_result(outcome)
+        finally:
+            self.write_task = None
+
+    def write_batch(self, funcs: list[Callable[[sqlite3.Cursor], Any]]) -> list[Any]:
+        """Run `funcs` in one transaction and return what each returned, or a
+        `WriteFailed` for those which raised."""
+        outcomes: list[Any] = []
+        with self.db() as (con, cur):
+            cur.execute("BEGIN IMMEDIATE")
+            for func in funcs:
+                cur.execute("SAVEPOINT write")
+                try:
+                    outcomes.append(func(cur))
+                except Exception as e:
+                    cur.execute("ROLLBACK TO write")
+                    outcomes.append(WriteFailed(e))
+                cur.execute("RELEASE write")
+            con.commit()
+        return outcomes
+
+    async def kdf(self, func: Callable[..., T], *args: Any) -> T:
+        """Run a password hashing function on the bounded hasher thread pool."""
+        return await asyncio.get_running_loop().run_in_executor(
+            self.hashers, func, *args
+        )
 
-    def db_fetchall(self, query: str, params: list[Any]) -> list[dict[str, Any]]:
-        con, cur = self.db()
-        cur = con.cursor()
-        rows = cur.execute(query, params).fetchall()
-        con.close()
-        return rows
+    async def fetchone(self, query: str, params: list[Any]) -> dict[str, Any] | None:
+        return await self.read(lambda cur: cur.execute(query, params).fetchone())
+
+    async def fetchall(self, query: str, params: list[Any]) -> list[dict[str, Any]]:
+        return await self.read(lambda cur: cur.execute(query, params).fetchall())
+
+    async def execute(self, query: str, params: list[Any]) -> int | None:
+        """Execute a single write statement and return its `lastrowid`."""
+        return await self.write(lambda cur: cur.execute(query, params).lastrowid)
+
+    @asynccontextmanager
+    async def lifespan(self, app: Starlette) -> AsyncGenerator[None, None]:
+        await asyncio.get_running_loop().run_in_executor(
+            self.writer, migrate, self.database
+        )
+        tasks = [
+            asyncio.create_task(worker())
+            for worker in [self.sessions.sweeper, *self.workers]
+        ]
+        yield
+        for task in tasks:
+            task.cancel()
+        if self.write_task is not None:
+            await self.write_task
+        self.readers.shutdown()
+        self.writer.shutdown()
+        self.hashers.shutdown()
+        self.pool.close()
 
     def create_starlette_application(self) -> Starlette:
         return Starlette(
+            lifespan=self.lifespan,
+            middleware=[Middleware(Profiler, main=self)],
             routes=[
                 *self.routes,
+                Route("/api/events", self.event_stream),
+                Route("/api/metrics", self.metrics_endpoint),
                 Mount("/dist", app=StaticFiles(directory="dist"), name="dist"),
                 Mount("/static", app=StaticFiles(directory="static"), name="static"),
                 Route("/{path:path}", self.application_route),
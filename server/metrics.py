@@ -0,0 +1,196 @@
+"""Request and SQL timings, exposed in the Prometheus text format at /api/metrics."""
+
+import bisect
+import re
+import sqlite3
+import threading
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Mapping
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+# How the body of an endpoint's error response starts, see `Error.to_JSONResponse`.
+ERROR_PREFIX = b'{"success":false'
+# Upper bounds of the histogram buckets, in seconds and in queries per request.
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...]):
+        self.buckets = buckets
+        # The last count is for values above every bucket.
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, name: str, labels: str) -> list[str]:
+        lines: list[str] = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {self.count}')
+        lines.append(f"{name}_sum{{{labels}}} {self.sum}")
+        lines.append(f"{name}_count{{{labels}}} {self.count}")
+        return lines
+
+
+@dataclass(slots=True)
+class RequestStats:
+    """The queries made on behalf of the current request."""
+
+    queries: int = 0
+    query_seconds: float = 0.0
+    # Set once the request's session is known.
+    user_id: int | None = None
+    # Each statement and how long it took, only kept when not `None`.
+    statements: list[tuple[str, float]] | None = None
+
+
+# Set for the duration of every instrumented request. `Main.read` and `Main.write`
+# carry it into the database threads.
+request_stats: ContextVar[RequestStats | None] = ContextVar(
+    "request_stats", default=None
+)
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.errors = 0
+
+
+class Metrics:
+    """Collects a latency and a queries per request histogram and an error count
+    for every route, and a latency histogram for every SQL statement."""
+
+    def __init__(self):
+        self.routes: dict[str, RouteMetrics] = {}
+        self.statements: dict[str, Histogram] = {}
+        # Statements are timed on the database threads.
+        self.lock = threading.Lock()
+
+    def instrument(
+        self, path: str, endpoint: Callable[[Request], Awaitable[Response]]
+    ) -> Callable[[Request], Awaitable[Response]]:
+        """Wrap `endpoint` to record its requests under `path`."""
+        route = self.routes[path] = RouteMetrics()
+
+        async def instrumented(request: Request) -> Response:
+            # Share the stats of an outer middleware, like the profiler's.
+            stats = request_stats.get() or RequestStats()
+            token = request_stats.set(stats)
+            start = time.perf_counter()
+            try:
+                response = await endpoint(request)
+            except BaseException:
+                route.errors += 1
+                raise
+            finally:
+                route.latency.observe(time.perf_counter() - start)
+                route.queries.observe(stats.queries)
+                request_stats.reset(token)
+            # `body` may be a memoryview, only its start is copied.
+            if bytes(response.body[: len(ERROR_PREFIX)]) == ERROR_PREFIX:
+                route.errors += 1
+            return response
+
+        return instrumented
+
+    def observe_query(self, sql: str, seconds: float) -> None:
+        stats = request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.query_seconds += seconds
+        statement = normalize_statement(sql)
+        if stats is not None and stats.statements is not None:
+            stats.statements.append((statement, seconds))
+        with self.lock:
+            histogram = self.statements.get(statement)
+            if histogram is None:
+                histogram = self.statements[statement] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+
+    def render(self, counters: Mapping[str, float], gauges: Mapping[str, float]) -> str:
+        """Render every metric, plus other `counters` and `gauges` by name, in the
+        Prometheus text format."""
+        labels = {path: f'route="{escape(path)}"' for path in self.routes}
+        # Each family's samples must follow its TYPE line together.
+        lines = ["# TYPE notifyme_request_duration_seconds histogram"]
+        for path, route in self.routes.items():
+            lines += route.latency.render(
+                "notifyme_request_duration_seconds", labels[path]
+            )
+        lines.append("# TYPE notifyme_request_queries histogram")
+        for path, route in self.routes.items():
+            lines += route.queries.render("notifyme_request_queries", labels[path])
+        lines.append("# TYPE notifyme_request_errors_total counter")
+        for path, route in self.routes.items():
+            lines.append(
+                f"notifyme_request_errors_total{{{labels[path]}}} {route.errors}"
+            )
+        lines.append("# TYPE notifyme_sql_duration_seconds histogram")
+        with self.lock:
+            for statement, histogram in self.statements.items():
+                lines += histogram.render(
+                    "notifyme_sql_duration_seconds", f'statement="{escape(statement)}"'
+                )
+        for type, metrics in (("counter", counters), ("gauge", gauges)):
+            for name, value in metrics.items():
+                lines.append(f"# TYPE {name} {type}")
+                lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def normalize_statement(sql: str) -> str:
+    return " ".join(sql.split())
+
+
+def escape(value: str) -> str:
+    return re.sub(r'(["\\])', r"\\\1", value).replace("\n", "\\n")
+
+
+class InstrumentedCursor(sqlite3.Cursor):
+    """A cursor which reports how long each statement it executes takes."""
+
+    def __init__(self, con: sqlite3.Connection, metrics: Metrics):
+        super().__init__(con)
+        self.metrics = metrics
+
+    def execute(self, sql: str, parameters: Any = (), /) -> "InstrumentedCursor":
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.metrics.observe_query(sql, time.perf_counter() - start)
+
+    def executemany(self, sql: str, parameters: Any, /) -> "InstrumentedCursor":
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, parameters)
+        finally:
+            self.metrics.observe_query(sql, time.perf_counter() - start)
@@ -0,0 +1,221 @@
+"""Versioned schema migrations, so databases are upgraded in place instead of being
+recreated.
+
+The version of a database is kept in `PRAGMA user_version`, the number of entries of
+`MIGRATIONS` applied to it. Each migration runs in its own transaction, and is
+written so that it also applies cleanly to databases which already have some of what
+it adds, as those made before migrations existed do.
+
+Usage:
+  $ python -m server.migrations [database.db]
+"""
+
+import sqlite3
+import sys
+from typing import Callable
+
+Migration = str | Callable[[sqlite3.Cursor], None]
+
+
+def add_post_version(cur: sqlite3.Cursor) -> None:
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(post)")]
+    if "version" not in columns:
+        cur.execute("ALTER TABLE post ADD COLUMN version integer not null default 0")
+
+
+def add_user_deleted_time(cur: sqlite3.Cursor) -> None:
+    columns = [row[1] for row in cur.execute("PRAGMA table_info(user)")]
+    if "deleted_time" not in columns:
+        cur.execute("ALTER TABLE user ADD COLUMN deleted_time integer default null")
+
+
+MIGRATIONS: list[Migration] = [
+    # 1: Users, posts and reactions.
+    """create table if not exists user (
+         id            integer primary key,
+         username      text not null unique,
+         password_hash text not null,
+         display_name  text not null,
+         avatar_url    text default null,
+         tags          text not null default "[]",
+         permission    integer not null default 0,
+         created_time  integer not null default (unixepoch())
+       );
+       create table if not exists post (
+         id           integer primary key,
+         author_id    integer not null,
+         content      text not null,
+         tags         text not null,
+         recipients   text not null,
+         created_time integer not null default (unixepoch()),
+         foreign key(author_id) references user(id)
+       );
+       create table if not exists reaction (
+         id           integer primary key,
+         emoji        integer not null,
+         post_id      integer not null,
+         user_id      integer not null,
+         created_time integer not null default (unixepoch()),
+         foreign key(post_id) references post(id),
+         foreign key(user_id) references user(id),
+         unique (emoji, post_id, user_id)
+       );""",
+    # 2: Posts by tag and by recipient, filled from the JSON columns of post.
+    """create table if not exists post_tag (
+         post_id integer not null,
+         tag     text not null,
+         primary key (post_id, tag),
+         foreign key(post_id) references post(id)
+       ) without rowid;
+       create index if not exists post_tag_tag on post_tag (tag, post_id);
+       create table if not exists post_recipient (
+         post_id  integer not null,
+         username text not null,
+         primary key (post_id, username),
+         foreign key(post_id) references post(id)
+       ) without rowid;
+       create index if not exists post_recipient_username
+         on post_recipient (username, post_id);
+       insert or ignore into post_tag (post_id, tag)
+         select p.id, j.value from post p, json_each(p.tags) j;
+       insert or ignore into post_recipient (post_id, username)
+         select p.id, j.value from post p, json_each(p.recipients) j;""",
+    # 3: Feeds fanned out on write, filled by scripts/build_inbox.py when enabling
+    # `Main.fanout`.
+    """create table if not exists inbox (
+         user_id integer not null,
+         post_id integer not null,
+         primary key (user_id, post_id),
+         foreign key(user_id) references user(id),
+         foreign key(post_id) references post(id)
+       ) without rowid;
+       create index if not exists inbox_post on inbox (post_id);""",
+    # 4: Sessions shared between workers.
+    """create table if not exists session (
+         token        text primary key,
+         user_id      integer not null,
+         created_time integer not null default (unixepoch()),
+         foreign key(user_id) references user(id)
+       );
+       create index if not exists session_user on session (user_id);
+       create index if not exists session_created on session (created_time);""",
+    # 5: Versions for conditional GETs, see server/versions.py.
+    """create table if not exists change_sequence (
+         value integer not null
+       );
+       insert into change_sequence (value)
+         select 0 where not exists (select 1 from change_sequence);""",
+    # 6: The change sequence value of the last write to each post.
+    add_post_version,
+    # 7: Reaction counts kept by their writers, filled from reaction.
+    """create index if not exists reaction_post_user on reaction (post_id, user_id);
+       create table if not exists reaction_count (
+         post_id integer not null,
+         emoji   integer not null,
+         count   integer not null,
+         primary key (post_id, emoji),
+         foreign key(post_id) references post(id)
+       ) without rowid;
+       delete from reaction_count;
+       insert into reaction_count (post_id, emoji, count)
+         select post_id, emoji, count(*) from reaction
+         where post_id in (select id from post)
+         group by post_id, emoji;""",
+    # 8: Full-text index of post.content, kept in step with post by triggers.
+    """create virtual table if not exists post_search using fts5 (
+         content,
+         content = 'post',
+         content_rowid = 'id'
+       );
+       create trigger if not exists post_search_insert after insert on post begin
+         insert into post_search (rowid, content) values (new.id, new.content);
+       end;
+       create trigger if not exists post_search_delete after delete on post begin
+         insert into post_search (post_search, rowid, content)
+         values ('delete', old.id, old.content);
+       end;
+       create trigger if not exists post_search_update
+       after update of content on post begin
+         insert into post_search (post_search, rowid, content)
+         values ('delete', old.id, old.content);
+         insert into post_search (rowid, content) values (new.id, new.content);
+       end;
+       insert into post_search (post_search) values ('rebuild');""",
+    # 9: Indexes for deleting a user's posts and reactions, and for listing posts by
+    # time. reaction (post_id) is served by reaction_post_user.
+    """create index if not exists post_author on post (author_id);
+       create index if not exists post_created on post (created_time);
+       create index if not exists reaction_user on reaction (user_id);""",
+    # 10: When a user asked for their account to be deleted, see server/deletion.py.
+    add_user_deleted_time,
+    # 11: Progress of account deletions, unfinished ones are resumed on startup.
+    """create table if not exists user_deletion (
+         token             text primary key,
+         user_id           integer not null,
+         posts             integer not null,
+         posts_deleted     integer not null default 0,
+         reactions         integer not null,
+         reactions_deleted integer not null default 0,
+         started_time      integer not null default (unixepoch()),
+         finished_time     integer default null
+       );
+       create index if not exists user_deletion_unfinished
+         on user_deletion (started_time) where finished_time is null;""",
+    # 12: Versions of the feed cache's pages by tag, see server/versions.py.
+    """create table if not exists tag_version (
+         tag   text primary key,
+         value integer not null
+       ) without rowid;
+       insert or ignore into tag_version (tag, value)
+         select distinct tag, 0 from post_tag;""",
+]
+
+
+def run_script(cur: sqlite3.Cursor, script: str) -> None:
+    """Execute each statement of `script` with `cur`, unlike `executescript` without
+    committing first."""
+    statement = ""
+    for line in script.splitlines(keepends=True):
+        statement += line
+        if sqlite3.complete_statement(statement):
+            cur.execute(statement)
+            statement = ""
+    if statement.strip():
+        raise ValueError(f"Incomplete statement: {statement}")
+
+
+def migrate(database: str) -> int:
+    """Apply the migrations `database` doesn't have yet, creating it if it doesn't
+    exist, and return how many were applied."""
+    con = sqlite3.connect(database, isolation_level=None)
+    cur = con.cursor()
+    applied = 0
+    try:
+        for version, migration in enumerate(MIGRATIONS, 1):
+            # Check again under the write lock, another process may be migrating too.
+            cur.execute("BEGIN IMMEDIATE")
+            try:
+                if cur.execute("PRAGMA user_version").fetchone()[0] >= version:
+                    cur.execute("COMMIT")
+                    continue
+                if isinstance(migration, str):
+                    run_script(cur, migration)
+                else:
+                    migration(cur)
+                cur.execute(f"PRAGMA user_version = {version}")
+                cur.execute("COMMIT")
+            except BaseException:
+                cur.execute("ROLLBACK")
+                raise
+            applied += 1
+        if applied > 0:
+            # Let the query planner see the new indexes and the data they cover.
+            cur.execute("ANALYZE")
+    finally:
+        con.close()
+    return applied
+
+
+if __name__ == "__main__":
+    database = sys.argv[1] if len(sys.argv) > 1 else "database.db"
+    print(f"Applied {migrate(database)} migrations to {database}.")
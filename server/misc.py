@@ -1,17 +1,20 @@
 """Basically a minimalistic version of FastAPI."""
 
 import builtins
+import functools
+from dataclasses import dataclass, field
 from types import GenericAlias, UnionType
 from typing import TYPE_CHECKING, Any, Awaitable, Callable
 
 from starlette.requests import Request
-from starlette.responses import JSONResponse, Response
+from starlette.responses import Response
 from starlette.routing import Route
 
 if TYPE_CHECKING:
     from rich.repr import RichReprResult
 
     from .main import Main
+    from .session import Session
 
 
 try:
@@ -19,6 +22,24 @@ try:
 except ImportError:
     print = print
 
+try:
+    import orjson
+
+    def json_dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+
+    json_loads: Callable[[bytes], Any] = orjson.loads
+except ImportError:
+    import json
+
+    # Encodes exactly like Starlette's JSONResponse.
+    def json_dumps(obj: Any) -> bytes:
+        return json.dumps(
+            obj, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+        ).encode()
+
+    json_loads = json.loads
+
 
 JSON = (
     None
@@ -43,20 +64,29 @@ class Error(Exception):
     def __init__(self, exception: str):
         super().__init__(exception)
 
-    def to_JSONResponse(self) -> JSONResponse:
-        return JSONResponse({"success": False, "error": self.args[0]})
+    def to_JSONResponse(self, dumps: Callable[[Any], bytes]) -> Response:
+        return JSONResponse(dumps({"success": False, "error": self.args[0]}))
+
+
+class JSONResponse(Response):
+    """A response whose content is already encoded JSON."""
+
+    media_type = "application/json"
+
+
+def success_response(dumps: Callable[[Any], bytes], response: RESPONSE) -> Response:
+    # Copying the few top-level keys is much cheaper than splicing the encoded body.
+    return JSONResponse(dumps({"success": True, **response}))
 
 
 class Model:
     def __init__(self, data: dict[str, Any]):
-        for name, T in type(self).__annotations__.items():
+        for name, convert in compile_model(type(self)):
             try:
                 value = data[name]
             except KeyError:
                 raise TypeError(f"DATA DOES NOT HAVE FIELD {name}")
-            if not isoftype(value, T):
-                raise TypeError(f"FIELD {name} HAS INCORRECT TYPE")
-            setattr(self, name, T(data[name]) if issubclass(T, Model) else data[name])
+            setattr(self, name, convert(value))
 
     def to_dict(self) -> RESPONSE:
         data: RESPONSE = {}
@@ -74,52 +104,128 @@ class Model:
 
 
 def isoftype(obj: Any, T: Any) -> bool:
+    return compile_check(T)(obj)
+
+
+@functools.cache
+def compile_check(T: Any) -> Callable[[Any], bool]:
+    """Compile `T` into a function which checks whether a JSON value is of type `T`."""
+    if T is Any:
+        return lambda obj: True
     if T in (str, int, float, bool, type(None)):
-        return isinstance(obj, T)
+        return lambda obj: isinstance(obj, T)
     elif T is None:
-        return obj is None
+        return lambda obj: obj is None
     elif isinstance(T, UnionType):
-        return any(isoftype(obj, subT) for subT in T.__args__)
+        checks = [compile_check(subT) for subT in T.__args__]
+        return lambda obj: any(check(obj) for check in checks)
     elif isinstance(T, GenericAlias) and T.__name__ == "list":
-        return isinstance(obj, list) and all(
-            isoftype(each, T.__args__[0]) for each in obj  # type: ignore
+        check_item = compile_check(T.__args__[0])
+        return lambda obj: isinstance(obj, list) and all(
+            check_item(each) for each in obj  # type: ignore
         )
     elif isinstance(T, GenericAlias) and T.__name__ == "dict":
-        return isinstance(obj, dict) and all(
-            isoftype(each, T.__args__[1]) for each in obj.values()  # type: ignore
+        check_value = compile_check(T.__args__[1])
+        return lambda obj: isinstance(obj, dict) and all(
+            check_value(each) for each in obj.values()  # type: ignore
         )
     elif issubclass(T, Model):  # type: ignore
-        try:
-            T(obj)
-            return True
-        except TypeError:
-            pass
-    return False
+
+        def check(obj: Any) -> bool:
+            try:
+                T(obj)
+                return True
+            except TypeError:
+                return False
+
+        return check
+    return lambda obj: False
+
+
+@functools.cache
+def compile_converter(T: Any) -> Callable[[Any], Any]:
+    """Compile `T` into a function which validates a JSON value against `T` and
+    returns the value to use, `Model` instances for `Model` and `list[Model]` types.
+
+    The returned function raises `TypeError` if the value is not of type `T`.
+    """
+    if isinstance(T, builtins.type) and issubclass(T, Model):
+        return T
+    if (
+        isinstance(T, GenericAlias)
+        and T.__name__ == "list"
+        and isinstance(T.__args__[0], builtins.type)
+        and issubclass(T.__args__[0], Model)
+    ):
+        itemT: type[Model] = T.__args__[0]
+
+        def convert_list(obj: Any) -> Any:
+            if not isinstance(obj, list):
+                raise TypeError
+            return [itemT(each) for each in obj]  # type: ignore
+
+        return convert_list
+    check = compile_check(T)  # type: ignore
+
+    def convert(obj: Any) -> Any:
+        if not check(obj):
+            raise TypeError
+        return obj
+
+    return convert
+
+
+@functools.cache
+def compile_model(T: "type[Model]") -> list[tuple[str, Callable[[Any], Any]]]:
+    return [
+        (name, compile_converter(fieldT)) for name, fieldT in T.__annotations__.items()
+    ]
 
 
 def parse_query_parameter(parameter: str, type: Any) -> Any:
-    try:
-        if type is bool:
-            return bool(parameter)
-        if type is str:
-            return parameter
-        if type is int:
-            return int(parameter)
-        if type is float:
-            return float(parameter)
-        if type in (type(None), None):
-            return None
-        if isinstance(type, UnionType):
-            for member_type in type.__args__:
+    return compile_parser(type)(parameter)
+
+
+@functools.cache
+def compile_parser(T: Any) -> Callable[[str], Any]:
+    """Compile `T` into a function which parses a query parameter of type `T`.
+
+    The returned function raises `TypeError` if the parameter can't be parsed.
+    """
+    if T is bool:
+        return bool
+    if T is str:
+        return lambda parameter: parameter
+    if T in (int, float):
+
+        def parse(parameter: str) -> Any:
+            try:
+                return T(parameter)
+            except (ValueError, TypeError):
+                raise TypeError
+
+        return parse
+    if T in (builtins.type(None), None):
+        return lambda parameter: None
+    if isinstance(T, UnionType):
+        parsers = [compile_parser(memberT) for memberT in T.__args__]
+
+        def parse_union(parameter: str) -> Any:
+            for parse in parsers:
                 try:
-                    return parse_query_parameter(parameter, member_type)
+                    return parse(parameter)
                 except TypeError:
                     continue
-    except (ValueError, TypeError):
-        raise TypeError
+
+        return parse_union
+    return lambda parameter: None
 
 
 EndpointFunction = Callable[..., Awaitable[RESPONSE]]
+ETagFunction = Callable[..., Awaitable[str | None]]
+EndpointCall = Callable[
+    [Request, "Session | None", dict[str, Any]], Awaitable[RESPONSE]
+]
 
 
 def validate_endpoint_function(
@@ -144,54 +250,130 @@ def validate_endpoint_function(
         raise SyntaxError("Second parameter must be - session: .sessions.Session")
 
 
+def compile_parameters(
+    func: EndpointFunction, compile: Callable[[Any], Callable[[Any], Any]]
+) -> list[tuple[str, bool, Callable[[Any], Any], str]]:
+    """Compile the parameters taken from the request into a list of
+    `(name, optional, convert, type name)`, so each request is a flat loop over it.
+    """
+    return [
+        (
+            name,
+            isinstance(type, UnionType) and builtins.type(None) in type.__args__,
+            compile(type),
+            strtype(type),
+        )
+        for name, type in func.__annotations__.items()
+        if name not in ("request", "session", "return")
+    ]
+
+
+def authorize(session: "Session | None", permissions: tuple[int, ...]) -> "Session":
+    """Return `session`, or raise an `Error` if it may not call the endpoint."""
+    if session is None:
+        raise Error("This API endpoint requires you to be logged in.")
+    if len(permissions) > 0 and session.permission not in permissions:
+        raise Error("Unauthorized to access this endpoint.")
+    return session
+
+
+@dataclass(slots=True)
+class Endpoint:
+    """An endpoint function with its JSON parameters compiled, callable in-process.
+
+    This is what POST endpoints run for each request, and what `/api/batch` runs for
+    each call, for GET endpoints too.
+    """
+
+    func: EndpointFunction
+    require_logged_in: bool
+    permissions: tuple[int, ...]
+    parameters: list[tuple[str, bool, Callable[[Any], Any], str]] = field(init=False)
+
+    def __post_init__(self):
+        self.parameters = compile_parameters(self.func, compile_converter)
+
+    async def call(
+        self, request: Request, session: "Session | None", data: dict[str, Any]
+    ) -> RESPONSE:
+        """Call the endpoint with arguments taken from `data`.
+
+        Raises `Error` if `session` may not call it or `data` doesn't match its
+        parameters.
+        """
+        kwargs: dict[str, Any] = {"request": request}
+        if self.require_logged_in:
+            kwargs["session"] = authorize(session, self.permissions)
+        for name, optional, convert, typename in self.parameters:
+            value = data.get(name)
+            if value is None:
+                if optional:
+                    kwargs[name] = None
+                    continue
+                if name not in data:
+                    raise Error(f"Missing parameter {name} of type {typename}.")
+            try:
+                kwargs[name] = convert(value)
+            except TypeError:
+                raise Error(f"Parameter {name} must be of type {typename}.")
+        return await self.func(**kwargs)
+
+
 def GET_endpoint_decorator(
-    main: "Main", path: str, require_logged_in: bool, permissions: tuple[int, ...]
+    main: "Main",
+    path: str,
+    require_logged_in: bool,
+    permissions: tuple[int, ...],
+    etag: ETagFunction | None,
 ):
     def decorator(func: EndpointFunction) -> EndpointFunction:
         validate_endpoint_function(func, require_logged_in, permissions)
+        parameters = compile_parameters(func, compile_parser)
+        call = Endpoint(func, require_logged_in, permissions).call
 
         async def endpoint(request: Request) -> Response:
             params = {**request.path_params, **request.query_params}
             kwargs: dict[str, Any] = {"request": request}
             if require_logged_in:
-                kwargs["session"] = main.sessions.get_session(request)
-                if kwargs["session"] is None:
-                    return Error(
-                        "This API endpoint requires you to be logged in."
-                    ).to_JSONResponse()
-                if (
-                    len(permissions) > 0
-                    and kwargs["session"].permission not in permissions
-                ):
-                    return Error(
-                        "Unauthorized to access this endpoint."
-                    ).to_JSONResponse()
-            for name, type in func.__annotations__.items():
-                if name in ("request", "session", "return"):
-                    continue
+                try:
+                    kwargs["session"] = authorize(
+                        await main.sessions.get_session(request), permissions
+                    )
+                except Error as err:
+                    return err.to_JSONResponse(main.json_dumps)
+            for name, optional, parse, typename in parameters:
                 if name not in params:
-                    if (
-                        isinstance(type, UnionType)
-                        and builtins.type(None) in type.__args__
-                    ):
-                        params[name] = None
-                    else:
-                        return Error(
-                            f"Missing query parameter {name} of type {strtype(type)}."
-                        ).to_JSONResponse()
+                    if optional:
+                        kwargs[name] = None
+                        continue
+                    return Error(
+                        f"Missing query parameter {name} of type {typename}."
+                    ).to_JSONResponse(main.json_dumps)
                 try:
-                    kwargs[name] = parse_query_parameter(params[name], type)
+                    kwargs[name] = parse(params[name])
                 except TypeError:
                     return Error(
-                        f"Query parameter {name} must be of type {strtype(type)}."
-                    ).to_JSONResponse()
+                        f"Query parameter {name} must be of type {typename}."
+                    ).to_JSONResponse(main.json_dumps)
+            headers: dict[str, str] = {}
+            tag = None if etag is None else await etag(**kwargs)
+            if tag is not None:
+                headers = {"ETag": f'"{tag}"', "Cache-Control": "no-cache"}
+                if_none_match = request.headers.get("if-none-match", "").split(",")
+                if headers["ETag"] in (each.strip() for each in if_none_match):
+                    return Response(status_code=304, headers=headers)
             try:
                 response = await func(**kwargs)
             except Error as err:
-                return err.to_JSONResponse()
-            return JSONResponse({"success": True, **response})
+                return err.to_JSONResponse(main.json_dumps)
+            response = success_response(main.json_dumps, response)
+            response.headers.update(headers)
+            return response
 
-        main.routes.append(Route(path, endpoint, methods=["GET"]))
+        main.routes.append(
+            Route(path, main.metrics.instrument(path, endpoint), methods=["GET"])
+        )
+        main.endpoints[("GET", path)] = call
         return func
 
     return decorator
@@ -202,52 +384,25 @@ def POST_endpoint_decorator(
 ):
     def decorator(func: EndpointFunction) -> EndpointFunction:
         validate_endpoint_function(func, require_logged_in, permissions)
+        call = Endpoint(func, require_logged_in, permissions).call
 
         async def endpoint(request: Request) -> Response:
-            data: dict[str, Any] = await request.json()
-            kwargs: dict[str, Any] = {"request": request}
-            if require_logged_in:
-                kwargs["session"] = main.sessions.get_session(request)
-                if kwargs["session"] is None:
-                    return Error(
-                        "This API endpoint requires you to be logged in."
-                    ).to_JSONResponse()
-                if (
-                    len(permissions) > 0
-                    and kwargs["session"].permission not in permissions
-                ):
-                    return Error(
-                        "Unauthorized to access this endpoint."
-                    ).to_JSONResponse()
-            for name, type in func.__annotations__.items():
-                if name in ("request", "session", "return"):
-                    continue
-                if name not in data:
-                    if (
-                        isinstance(type, UnionType)
-                        and builtins.type(None) in type.__args__
-                    ):
-                        data[name] = None
-                    else:
-                        return Error(
-                            f"Missing parameter {name} of type {strtype(type)}."
-                        ).to_JSONResponse()
-                if not isoftype(data[name], type):
-                    return Error(
-                        f"Parameter {name} must be of type {strtype(type)}."
-                    ).to_JSONResponse()
-                kwargs[name] = (
-                    type(data[name])
-                    if isinstance(type, builtins.type) and issubclass(type, Model)
-                    else data[name]
-                )
+            data: dict[str, Any] = main.json_loads(await request.body())
             try:
-                response = await func(**kwargs)
+                session = (
+                    await main.sessions.get_session(request)
+                    if require_logged_in
+                    else None
+                )
+                response = await call(request, session, data)
             except Error as err:
-                return err.to_JSONResponse()
-            return JSONResponse({"success": True, **response})
+                return err.to_JSONResponse(main.json_dumps)
+            return success_response(main.json_dumps, response)
 
-        main.routes.append(Route(path, endpoint, methods=["POST"]))
+        main.routes.append(
+            Route(path, main.metrics.instrument(path, endpoint), methods=["POST"])
+        )
+        main.endpoints[("POST", path)] = call
         return func
 
     return decorator
@@ -0,0 +1,69 @@
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Generator
+
+PRAGMAS = (
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA mmap_size = 268435456",
+)
+
+
+class ConnectionPool:
+    """A bounded pool of pre-configured SQLite connections.
+
+    Connections are opened lazily, up to `size` of them. Checking out a connection
+    while all of them are in use blocks until one is returned.
+    """
+
+    def __init__(self, database: str, size: int = 8) -> None:
+        self.database = database
+        self.size = size
+        self.opened = 0
+        self.idle: queue.LifoQueue[sqlite3.Connection] = queue.LifoQueue()
+        self.lock = threading.Lock()
+
+    def connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.database, check_same_thread=False)
+        con.row_factory = sqlite3.Row
+        for pragma in PRAGMAS:
+            con.execute(pragma)
+        return con
+
+    def checkout(self) -> sqlite3.Connection:
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.opened < self.size:
+                con = self.connect()
+                self.opened += 1
+                return con
+        return self.idle.get()
+
+    def checkin(self, con: sqlite3.Connection) -> None:
+        # Discard whatever the borrower left uncommitted.
+        con.rollback()
+        self.idle.put(con)
+
+    @contextmanager
+    def connection(self) -> Generator[sqlite3.Connection, None, None]:
+        con = self.checkout()
+        try:
+            yield con
+        finally:
+            self.checkin(con)
+
+    def close(self) -> None:
+        while True:
+            try:
+                con = self.idle.get_nowait()
+            except queue.Empty:
+                break
+            con.close()
+            with self.lock:
+                self.opened -= 1
@@ -1,50 +1,141 @@
 import json
+import sqlite3
 from typing import Any
 
 from starlette.requests import Request
 
 from . import main, sql
+from .inbox import fan_out_post
 from .misc import RESPONSE, Error
 from .session import Session
+from .versions import get_tag_versions, make_etag, next_version, touch_tags
 
+POSTS_PAGE_SIZE = 50
+POSTS_PAGE_SIZE_MAX = 200
+# Above every post id, the `before_id` of a feed's first page. A plain `post_id < ?`
+# lets SQLite seek straight to the cursor.
+POST_ID_MAX = 2**63 - 1
+# Feed queries filter their `post_id`s with this, so the posts of users being deleted
+# are skipped before the page's LIMIT instead of leaving it short.
+AUTHOR_NOT_DELETED = """NOT EXISTS (
+    SELECT 1 FROM post p, user u
+    WHERE p.id = post_id AND u.id = p.author_id AND u.deleted_time IS NOT NULL
+)"""
+# Most tags whose posts are read one tag at a time, see `tagged_posts_query`.
+FEED_TAGS_MERGE_MAX = 100
 
-@main.GET("/api/get_post")
-async def get_post(request: Request, session: Session, id: int) -> RESPONSE:
-    _, cur = main.db()
-    row = cur.execute(
-        """SELECT p.content, p.tags, p.recipients, p.created_time,
-           u.id as author_id,
-           u.username as author_username,
-           u.display_name as author_display_name,
-           u.avatar_url as author_avatar_url,
-           u.tags as author_tags,
-           u.permission as author_permission,
-           u.created_time as author_created_time
-           FROM post p, user u
-           WHERE p.id = ? AND u.id = p.author_id""",
+
+def get_reaction_counts(
+    cur: sqlite3.Cursor, post_ids: list[int]
+) -> dict[int, dict[int, int]]:
+    """Fetch how many of each emoji many posts have in a single query."""
+    counts: dict[int, dict[int, int]] = {}
+    for row in cur.execute(
+        """SELECT post_id, emoji, count FROM reaction_count
+           WHERE post_id IN (SELECT value FROM json_each(?))""",
+        [json.dumps(post_ids)],
+    ):
+        counts.setdefault(row["post_id"], {})[row["emoji"]] = row["count"]
+    return counts
+
+
+def get_user_reactions(
+    cur: sqlite3.Cursor, user_id: int, post_ids: list[int]
+) -> set[tuple[int, int]]:
+    """Fetch the `(post_id, emoji)` reactions a user made on many posts in a single
+    query."""
+    return {
+        (row["post_id"], row["emoji"])
+        for row in cur.execute(
+            """SELECT post_id, emoji FROM reaction
+               WHERE post_id IN (SELECT value FROM json_each(?)) AND user_id = ?""",
+            [json.dumps(post_ids), user_id],
+        )
+    }
+
+
+def summarize_reactions(
+    post_id: int, counts: dict[int, int], mine: set[tuple[int, int]]
+) -> dict[int, tuple[int, bool]]:
+    return {emoji: (count, (post_id, emoji) in mine) for emoji, count in counts.items()}
+
+
+def get_post_tags(cur: sqlite3.Cursor, post_id: int) -> list[str]:
+    return [
+        row["tag"]
+        for row in cur.execute("SELECT tag FROM post_tag WHERE post_id = ?", [post_id])
+    ]
+
+
+def get_post_recipients(cur: sqlite3.Cursor, post_id: int) -> list[str]:
+    return [
+        row["username"]
+        for row in cur.execute(
+            "SELECT username FROM post_recipient WHERE post_id = ?", [post_id]
+        )
+    ]
+
+
+def set_post_tags(cur: sqlite3.Cursor, post_id: int, tags: list[str]) -> None:
+    cur.execute("DELETE FROM post_tag WHERE post_id = ?", [post_id])
+    cur.executemany(
+        "INSERT OR IGNORE INTO post_tag (post_id, tag) VALUES (?, ?)",
+        [(post_id, tag) for tag in tags],
+    )
+
+
+def set_post_recipients(
+    cur: sqlite3.Cursor, post_id: int, recipients: list[str]
+) -> None:
+    cur.execute("DELETE FROM post_recipient WHERE post_id = ?", [post_id])
+    cur.executemany(
+        "INSERT OR IGNORE INTO post_recipient (post_id, username) VALUES (?, ?)",
+        [(post_id, username) for username in recipients],
+    )
+
+
+async def get_post_etag(request: Request, session: Session, id: int) -> str | None:
+    row = await main.fetchone(
+        """SELECT p.version FROM post p, user u
+           WHERE p.id = ? AND u.id = p.author_id AND u.deleted_time IS NULL""",
         [id],
-    ).fetchone()
+    )
     if row is None:
-        raise Error("Post not found.")
+        return None
+    return make_etag(
+        id, row["version"], session.user_id, session.username, session.tags
+    )
+
+
+@main.GET("/api/get_post", etag=get_post_etag)
+async def get_post(request: Request, session: Session, id: int) -> RESPONSE:
+    def read(cur: sqlite3.Cursor) -> tuple[Any, dict[int, tuple[int, bool]]]:
+        row = cur.execute(
+            """SELECT p.content, p.tags, p.recipients, p.created_time,
+               u.id as author_id,
+               u.username as author_username,
+               u.display_name as author_display_name,
+               u.avatar_url as author_avatar_url,
+               u.tags as author_tags,
+               u.permission as author_permission,
+               u.created_time as author_created_time
+               FROM post p, user u
+               WHERE p.id = ? AND u.id = p.author_id AND u.deleted_time IS NULL""",
+            [id],
+        ).fetchone()
+        if row is None:
+            raise Error("Post not found.")
+        return row, summarize_reactions(
+            id,
+            get_reaction_counts(cur, [id]).get(id, {}),
+            get_user_reactions(cur, session.user_id, [id]),
+        )
+
+    row, reactions = await main.read(read)
     tags: list[str] = json.loads(row["tags"])
     recipients: list[str] = json.loads(row["recipients"])
     if not (session.username in recipients or any(tag in tags for tag in session.tags)):
         raise Error("Not subscribed.")
-    rows = cur.execute(
-        """SELECT 
-           emoji,
-           COUNT(*) AS count,
-           COUNT(
-               CASE WHEN reaction.user_id = ? THEN TRUE ELSE FALSE END
-           ) AS is_user_reaction
-           FROM reaction
-           WHERE post_id = ?
-           GROUP BY emoji""",
-        [session.user_id, id],
-    ).fetchall()
-    reactions: dict[int, tuple[int, bool]] = {
-        row["emoji"]: (row["count"], bool(row["is_user_reaction"])) for row in rows
-    }
     return {
         "id": id,
         "author": {
@@ -64,45 +155,38 @@ async def get_post(request: Request, session: Session, id: int) -> RESPONSE:
     }
 
 
-@main.GET("/api/get_posts")
-async def get_posts(request: Request, session: Session) -> RESPONSE:
-    _, cur = main.db()
-    rows = cur.execute(
-        """SELECT p.id, p.content, p.tags, p.recipients, p.created_time,
-           u.id as author_id,
-           u.username as author_username,
-           u.display_name as author_display_name,
-           u.avatar_url as author_avatar_url,
-           u.tags as author_tags,
-           u.permission as author_permission,
-           u.created_time as author_created_time
-           FROM post p, user u
-           WHERE u.id = p.author_id""",
-        [],
-    ).fetchall()
+async def read_posts(visible: str, visible_args: list[Any], limit: int) -> list[Any]:
+    """Read the newest `limit` posts whose ids are selected by the `visible` query.
+
+    The posts are the same for every session, so their `reactions` only map each
+    emoji to its count. `add_user_reactions` turns them into what is sent.
+    """
+
+    def read(cur: sqlite3.Cursor) -> tuple[list[Any], dict[int, dict[int, int]]]:
+        rows = cur.execute(
+            f"""SELECT p.id, p.content, p.tags, p.recipients, p.created_time,
+               u.id as author_id,
+               u.username as author_username,
+               u.display_name as author_display_name,
+               u.avatar_url as author_avatar_url,
+               u.tags as author_tags,
+               u.permission as author_permission,
+               u.created_time as author_created_time
+               FROM post p, user u
+               WHERE u.id = p.author_id AND u.deleted_time IS NULL
+               AND p.id IN (
+                   {visible}
+                   ORDER BY post_id DESC
+                   LIMIT ?
+               )
+               ORDER BY p.id DESC""",
+            [*visible_args, limit],
+        ).fetchall()
+        return rows, get_reaction_counts(cur, [row["id"] for row in rows])
+
+    rows, reactions = await main.read(read)
     posts: list[Any] = []  # Problems with typing I CANNOT solve!
     for row in rows:
-        tags: list[str] = json.loads(row["tags"])
-        recipients: list[str] = json.loads(row["recipients"])
-        if not (
-            session.username in recipients or any(tag in tags for tag in session.tags)
-        ):
-            continue
-        rows2 = cur.execute(
-            """SELECT 
-               emoji,
-               COUNT(*) AS count,
-               COUNT(
-                   CASE WHEN reaction.user_id = ? THEN 1 ELSE 0 END
-               ) AS is_user_reaction
-               FROM reaction
-               WHERE post_id = ?
-               GROUP BY emoji""",
-            [session.user_id, row["id"]],
-        ).fetchall()
-        reactions: dict[int, tuple[int, bool]] = {
-            row["emoji"]: (row["count"], bool(row["is_user_reaction"])) for row in rows2
-        }
         posts.append(
             {
                 "id": row["id"],
@@ -116,13 +200,125 @@ async def get_posts(request: Request, session: Session) -> RESPONSE:
                     "created_time": row["created_time"],
                 },
                 "content": row["content"],
-                "tags": tags,
-                "recipients": recipients,
+                "tags": json.loads(row["tags"]),
+                "recipients": json.loads(row["recipients"]),
                 "created_time": row["created_time"],
-                "reactions": reactions,
+                "reactions": reactions.get(row["id"], {}),
             }
         )
-    return {"posts": posts}
+    return posts
+
+
+async def read_post(id: int) -> Any | None:
+    """Read a post like `read_posts` does, `None` if it doesn't exist."""
+    posts = await read_posts("SELECT ? AS post_id", [id], 1)
+    return posts[0] if posts else None
+
+
+async def add_user_reactions(session: Session, posts: list[Any]) -> list[Any]:
+    """Copy `posts` from `read_posts` with the session's own reactions flagged."""
+    mine = await main.read(
+        lambda cur: get_user_reactions(
+            cur, session.user_id, [post["id"] for post in posts]
+        )
+    )
+    return [
+        {**post, "reactions": summarize_reactions(post["id"], post["reactions"], mine)}
+        for post in posts
+    ]
+
+
+def tagged_posts_query(
+    tags: tuple[str, ...], cursor: int, limit: int
+) -> tuple[str, list[Any]]:
+    """Build the `read_posts` query for the posts with any of `tags` before `cursor`.
+
+    Each tag's newest `limit` posts are read from post_tag_tag and merged, so rare
+    tags cost as little as popular ones. Most posts have one of many tags anyway,
+    so past `FEED_TAGS_MERGE_MAX` tags post_tag is read down from the cursor.
+    """
+    if len(tags) > FEED_TAGS_MERGE_MAX:
+        return (
+            f"""SELECT DISTINCT post_id FROM post_tag
+                WHERE tag IN (SELECT value FROM json_each(?)) AND post_id < ?
+                AND {AUTHOR_NOT_DELETED}""",
+            [json.dumps(tags), cursor],
+        )
+    newest = f"""SELECT post_id FROM (
+                     SELECT post_id FROM post_tag WHERE tag = ? AND post_id < ?
+                     AND {AUTHOR_NOT_DELETED}
+                     ORDER BY post_id DESC
+                     LIMIT ?
+                 )"""
+    return (
+        " UNION ".join([newest] * len(tags)),
+        [arg for tag in tags for arg in (tag, cursor, limit)],
+    )
+
+
+async def get_posts_etag(
+    request: Request, session: Session, before_id: int | None, limit: int | None
+) -> str | None:
+    row = await main.fetchone("SELECT value FROM change_sequence", [])
+    assert row is not None
+    return make_etag(
+        row["value"],
+        session.user_id,
+        session.username,
+        session.tags,
+        before_id,
+        limit,
+        main.fanout,
+    )
+
+
+@main.GET("/api/get_posts", etag=get_posts_etag)
+async def get_posts(
+    request: Request, session: Session, before_id: int | None, limit: int | None
+) -> RESPONSE:
+    """Return one page of the session's feed, newest first.
+
+    Pass the returned `next` as `before_id` to fetch the following page, `next` is
+    `None` once the feed is exhausted.
+    """
+    limit = min(max(limit or POSTS_PAGE_SIZE, 1), POSTS_PAGE_SIZE_MAX)
+    cursor = before_id if before_id is not None else POST_ID_MAX
+    if main.fanout:
+        posts = await read_posts(
+            f"""SELECT post_id FROM inbox
+                WHERE user_id = ? AND post_id < ? AND {AUTHOR_NOT_DELETED}""",
+            [session.user_id, cursor],
+            limit,
+        )
+    else:
+        key = main.feed_cache.key(session.tags, before_id, limit)
+        tagged: list[Any] | None = []
+        if key[0]:
+            # Read before the page, so a write landing in between makes it stale.
+            versions = await main.read(lambda cur: get_tag_versions(cur, key[0]))
+            tagged = main.feed_cache.get(key, versions)
+            if tagged is None:
+                version = main.feed_cache.version
+                tagged = await read_posts(
+                    *tagged_posts_query(key[0], cursor, limit), limit
+                )
+                main.feed_cache.put(key, tagged, version, versions)
+        received = await read_posts(
+            f"""SELECT post_id FROM post_recipient
+                WHERE username = ? AND post_id < ? AND {AUTHOR_NOT_DELETED}""",
+            [session.username, cursor],
+            limit,
+        )
+        posts = list({post["id"]: post for post in [*tagged, *received]}.values())
+        posts.sort(key=lambda post: post["id"], reverse=True)
+        del posts[limit:]
+    posts = await add_user_reactions(session, posts)
+    return {"posts": posts, "next": posts[-1]["id"] if len(posts) == limit else None}
+
+
+@main.GET("/api/feed_cache_stats", permissions=(1,))
+async def feed_cache_stats(request: Request, session: Session) -> RESPONSE:
+    return main.feed_cache.stats()
 
 
 @main.POST("/api/new_post", permissions=(1,))
@@ -133,14 +329,32 @@ async def new_post(
     tags: list[str],
     recipients: list[str],
 ) -> RESPONSE:
-    con, cur = main.db()
-    cur.execute(
-        """INSERT INTO post (author_id, content, tags, recipients)
-           VALUES (?, ?, ?, ?)""",
-        (session.user_id, content, json.dumps(tags), json.dumps(recipients)),
+    def write(cur: sqlite3.Cursor) -> int:
+        cur.execute(
+            """INSERT INTO post (author_id, content, tags, recipients, version)
+               VALUES (?, ?, ?, ?, ?)""",
+            (
+                session.user_id,
+                content,
+                json.dumps(tags),
+                json.dumps(recipients),
+                next_version(cur),
+            ),
+        )
+        id: int = cur.lastrowid  # type: ignore
+        set_post_tags(cur, id, tags)
+        set_post_recipients(cur, id, recipients)
+        touch_tags(cur, tags)
+        if main.fanout:
+            fan_out_post(cur, id)
+        return id
+
+    id = await main.write(write)
+    main.feed_cache.invalidate(tags)
+    main.events.publish(
+        "post_created", {"id": id, "post": await read_post(id)}, tags, recipients
     )
-    con.commit()
-    return {"id": cur.lastrowid}
+    return {"id": id}
 
 
 @main.POST("/api/edit_post", permissions=(1,))
@@ -152,36 +366,73 @@ async def edit_post(
     tags: list[str] | None,
     recipients: list[str] | None,
 ) -> RESPONSE:
-    con, cur = main.db()
-    row = cur.execute("SELECT author_id FROM post WHERE id = ?", [id]).fetchone()
-    if row is None:
-        raise Error("Post not found.")
-    if row["author_id"] != session.user_id:
-        raise Error("Not author.")
-    cur.execute(
-        *sql.update(
-            "post",
-            set={
-                "content": content,
-                "tags": json.dumps(tags),
-                "recipients": json.dumps(recipients),
-            },
-            where="id = ?",
-            args=[id],
+    def write(cur: sqlite3.Cursor) -> tuple[list[str], list[str]]:
+        row = cur.execute("SELECT author_id FROM post WHERE id = ?", [id]).fetchone()
+        if row is None:
+            raise Error("Post not found.")
+        if row["author_id"] != session.user_id:
+            raise Error("Not author.")
+        old_tags = get_post_tags(cur, id)
+        old_recipients = get_post_recipients(cur, id)
+        cur.execute(
+            *sql.update(
+                "post",
+                set={
+                    "content": content,
+                    "tags": json.dumps(tags) if tags is not None else None,
+                    "recipients": (
+                        json.dumps(recipients) if recipients is not None else None
+                    ),
+                    "version": next_version(cur),
+                },
+                where="id = ?",
+                args=[id],
+            )
         )
-    )
-    con.commit()
+        if tags is not None:
+            set_post_tags(cur, id, tags)
+        if recipients is not None:
+            set_post_recipients(cur, id, recipients)
+        touch_tags(cur, [*old_tags, *(tags or [])])
+        if main.fanout and (tags is not None or recipients is not None):
+            fan_out_post(cur, id)
+        return old_tags, old_recipients
+
+    old_tags, old_recipients = await main.write(write)
+    new_tags = tags if tags is not None else old_tags
+    new_recipients = recipients if recipients is not None else old_recipients
+    main.feed_cache.invalidate([*old_tags, *new_tags])
+    audience = main.events.subscribers(new_tags, new_recipients)
+    # To those who could see the post but no longer can, it is as good as deleted.
+    for subscriber in main.events.subscribers(old_tags, old_recipients) - audience:
+        subscriber.send(("post_deleted", {"id": id}))
+    event = ("post_edited", {"id": id, "post": await read_post(id)})
+    for subscriber in audience:
+        subscriber.send(event)
     return {}
 
 
 @main.POST("/api/delete_post", permissions=(1,))
 async def delete_post(request: Request, session: Session, id: int) -> RESPONSE:
-    con, cur = main.db()
-    row = cur.execute("SELECT author_id FROM post WHERE id = ?", [id]).fetchone()
-    if row is None:
-        raise Error("Post not found.")
-    if row["author_id"] != session.user_id:
-        raise Error("Not author.")
-    cur.execute("DELETE FROM post WHERE id = ?", [id])
-    con.commit()
+    def write(cur: sqlite3.Cursor) -> tuple[list[str], list[str]]:
+        row = cur.execute("SELECT author_id FROM post WHERE id = ?", [id]).fetchone()
+        if row is None:
+            raise Error("Post not found.")
+        if row["author_id"] != session.user_id:
+            raise Error("Not author.")
+        tags = get_post_tags(cur, id)
+        recipients = get_post_recipients(cur, id)
+        cur.execute("DELETE FROM post WHERE id = ?", [id])
+        cur.execute("DELETE FROM post_tag WHERE post_id = ?", [id])
+        cur.execute("DELETE FROM post_recipient WHERE post_id = ?", [id])
+        cur.execute("DELETE FROM inbox WHERE post_id = ?", [id])
+        cur.execute("DELETE FROM reaction WHERE post_id = ?", [id])
+        cur.execute("DELETE FROM reaction_count WHERE post_id = ?", [id])
+        next_version(cur)
+        touch_tags(cur, tags)
+        return tags, recipients
+
+    tags, recipients = await main.write(write)
+    main.feed_cache.invalidate(tags)
+    main.events.publish("post_deleted", {"id": id}, tags, recipients)
     return {}
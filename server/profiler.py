@@ -0,0 +1,177 @@
+"""Opt-in tracing of sampled and slow API requests, for finding hot spots in
+production without attaching a debugger.
+
+Each trace is a JSON file in `Main.profile_directory` with the request's path,
+status, session user id, latency and every SQL statement it ran, plus:
+
+- `profile`, a cProfile report, for the `Main.profile_rate` fraction of requests
+  picked at random. Requests share the event loop's thread, so the report also
+  includes whatever other requests ran meanwhile.
+- `stacks`, for requests still running after `Main.profile_slow_threshold` seconds,
+  the request's coroutine stack sampled every `STACK_SAMPLE_INTERVAL` seconds while
+  it waits, counted by stack in the collapsed format flame graph tools read.
+
+Only the newest `Main.profile_ring_size` traces are kept.
+"""
+
+import asyncio
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import time
+from types import FrameType
+from typing import TYPE_CHECKING, Any
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from .metrics import RequestStats, request_stats
+
+if TYPE_CHECKING:
+    from .main import Main
+
+STACK_SAMPLE_INTERVAL = 0.01
+# Functions of the cProfile report to keep, by cumulative time.
+PROFILE_FUNCTIONS = 40
+
+
+class StackSampler:
+    """Samples the stack of `task` until stopped."""
+
+    def __init__(self, task: "asyncio.Task[Any]"):
+        self.task = task
+        self.stacks: dict[str, int] = {}
+        self.handle: asyncio.TimerHandle | None = None
+
+    def start(self, delay: float) -> None:
+        self.handle = asyncio.get_running_loop().call_later(delay, self.sample)
+
+    def sample(self) -> None:
+        stack = ";".join(
+            f"{frame.f_code.co_name} ({frame.f_code.co_filename}:{frame.f_lineno})"
+            for frame in awaiting_frames(self.task.get_coro())
+        )
+        self.stacks[stack] = self.stacks.get(stack, 0) + 1
+        self.start(STACK_SAMPLE_INTERVAL)
+
+    def stop(self) -> None:
+        if self.handle is not None:
+            self.handle.cancel()
+
+
+def awaiting_frames(coroutine: Any) -> list[FrameType]:
+    """Return the frames of `coroutine` and of the coroutines it is awaiting, outermost
+    first. `Task.get_stack` only returns the outermost one of a suspended task."""
+    frames: list[FrameType] = []
+    while coroutine is not None:
+        frame = getattr(coroutine, "cr_frame", None) or getattr(
+            coroutine, "gi_frame", None
+        )
+        if frame is None:
+            break
+        frames.append(frame)
+        coroutine = getattr(coroutine, "cr_await", None) or getattr(
+            coroutine, "gi_yieldfrom", None
+        )
+    return frames
+
+
+class Profiler:
+    """ASGI middleware which writes a trace of sampled and slow API requests."""
+
+    def __init__(self, app: ASGIApp, main: "Main"):
+        self.app = app
+        self.main = main
+        # Only one cProfile profiler can be enabled at a time.
+        self.profiling = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        main = self.main
+        if (
+            scope["type"] != "http"
+            or not scope["path"].startswith("/api/")
+            or scope["path"] == "/api/events"
+            or (main.profile_rate <= 0 and main.profile_slow_threshold is None)
+        ):
+            await self.app(scope, receive, send)
+            return
+        status = 0
+
+        async def send_status(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        stats = RequestStats(statements=[])
+        token = request_stats.set(stats)
+        profile = None
+        if not self.profiling and random.random() < main.profile_rate:
+            self.profiling = True
+            profile = cProfile.Profile()
+        sampler = None
+        if main.profile_slow_threshold is not None:
+            task = asyncio.current_task()
+            assert task is not None
+            sampler = StackSampler(task)
+            sampler.start(main.profile_slow_threshold)
+        start = time.perf_counter()
+        try:
+            if profile is not None:
+                profile.enable()
+            await self.app(scope, receive, send_status)
+        finally:
+            if profile is not None:
+                profile.disable()
+                self.profiling = False
+            if sampler is not None:
+                sampler.stop()
+            request_stats.reset(token)
+        seconds = time.perf_counter() - start
+        slow = (
+            main.profile_slow_threshold is not None
+            and seconds >= main.profile_slow_threshold
+        )
+        if profile is None and not slow:
+            return
+        trace: dict[str, Any] = {
+            "time": time.time(),
+            "method": scope["method"],
+            "path": scope["path"],
+            "query_string": scope["query_string"].decode("latin-1"),
+            "status": status,
+            "user_id": stats.user_id,
+            "seconds": seconds,
+            "queries": [
+                {"sql": sql, "seconds": query_seconds}
+                for sql, query_seconds in stats.statements or []
+            ],
+            "profile": None if profile is None else report(profile),
+            "stacks": None if sampler is None else sampler.stacks,
+        }
+        await asyncio.get_running_loop().run_in_executor(None, self.save, trace)
+
+    def save(self, trace: dict[str, Any]) -> None:
+        directory = self.main.profile_directory
+        os.makedirs(directory, exist_ok=True)
+        name = f"{time.time_ns()}-{trace['path'].strip('/').replace('/', '-')}.json"
+        with open(os.path.join(directory, name), "w") as file:
+            json.dump(trace, file, indent=2)
+        traces = sorted(
+            each for each in os.listdir(directory) if each.endswith(".json")
+        )
+        for old in traces[: -self.main.profile_ring_size]:
+            # Another save running at the same time may have pruned it already.
+            try:
+                os.remove(os.path.join(directory, old))
+            except FileNotFoundError:
+                pass
+
+
+def report(profile: cProfile.Profile) -> str:
+    stream = io.StringIO()
+    stats = pstats.Stats(profile, stream=stream)
+    stats.sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PROFILE_FUNCTIONS)
+    return stream.getvalue()
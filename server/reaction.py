@@ -1,26 +1,102 @@
+import json
 import sqlite3
 
 from starlette.requests import Request
 
 from . import main
-from .misc import RESPONSE, Error
+from .misc import RESPONSE, Error, Model
+from .post import (
+    AUTHOR_NOT_DELETED,
+    get_post_recipients,
+    get_post_tags,
+    get_reaction_counts,
+)
 from .session import Session
+from .versions import touch_post, touch_tags
+
+# Most changes a single /api/set_reactions request may make.
+SET_REACTIONS_MAX = 200
+
+
+def count_reaction(cur: sqlite3.Cursor, post_id: int, emoji: int, delta: int) -> None:
+    """Add `delta` to a post's count of `emoji`, in the writer's transaction."""
+    cur.execute(
+        """INSERT INTO reaction_count (post_id, emoji, count) VALUES (?, ?, ?)
+           ON CONFLICT (post_id, emoji) DO UPDATE SET count = count + excluded.count""",
+        [post_id, emoji, delta],
+    )
+    if delta < 0:
+        cur.execute(
+            "DELETE FROM reaction_count WHERE post_id = ? AND emoji = ? AND count <= 0",
+            [post_id, emoji],
+        )
+
+
+def recount_reactions(cur: sqlite3.Cursor, pairs: list[tuple[int, int]]) -> None:
+    """Recompute the counts of the given `(post_id, emoji)` pairs from reaction."""
+    cur.executemany("DELETE FROM reaction_count WHERE post_id = ? AND emoji = ?", pairs)
+    cur.executemany(
+        """INSERT INTO reaction_count (post_id, emoji, count)
+           SELECT post_id, emoji, COUNT(*) FROM reaction
+           WHERE post_id = ? AND emoji = ?
+           GROUP BY post_id, emoji""",
+        pairs,
+    )
+
+
+def check_visible(cur: sqlite3.Cursor, session: Session, post_ids: list[int]) -> None:
+    """Raise `Error` unless every post in `post_ids` exists and the session can see
+    it."""
+    ids = json.dumps(post_ids)
+    visible = {
+        row["post_id"]
+        for row in cur.execute(
+            f"""SELECT post_id FROM (
+                    SELECT post_id FROM post_tag
+                    WHERE post_id IN (SELECT value FROM json_each(?))
+                    AND tag IN (SELECT value FROM json_each(?))
+                    UNION
+                    SELECT post_id FROM post_recipient
+                    WHERE post_id IN (SELECT value FROM json_each(?)) AND username = ?
+                )
+                WHERE {AUTHOR_NOT_DELETED}""",
+            [ids, json.dumps(session.tags), ids, session.username],
+        )
+    }
+    if not visible.issuperset(post_ids):
+        raise Error("Post not found.")
 
 
 @main.POST("/api/add_reaction")
 async def add_reaction(
     request: Request, session: Session, post_id: int, emoji: int
 ) -> RESPONSE:
-    con, cur = main.db()
-    try:
-        cur.execute(
-            "INSERT INTO reaction (emoji, post_id, user_id) VALUES (?, ?, ?)",
-            [emoji, post_id, session.user_id],
+    def write(cur: sqlite3.Cursor) -> tuple[list[str], list[str], dict[int, int]]:
+        check_visible(cur, session, [post_id])
+        try:
+            cur.execute(
+                "INSERT INTO reaction (emoji, post_id, user_id) VALUES (?, ?, ?)",
+                [emoji, post_id, session.user_id],
+            )
+        except sqlite3.IntegrityError as e:
+            if "UNIQUE constraint failed" in e.args[0]:
+                raise Error("Reaction exists.")
+            raise
+        count_reaction(cur, post_id, emoji, 1)
+        touch_post(cur, post_id)
+        tags = get_post_tags(cur, post_id)
+        touch_tags(cur, tags)
+        return (
+            tags,
+            get_post_recipients(cur, post_id),
+            get_reaction_counts(cur, [post_id]).get(post_id, {}),
         )
-    except sqlite3.IntegrityError as e:
-        if "UNIQUE constraint failed" in e.args[0]:
-            raise Error("Reaction exists.")
-    con.commit()
+
+    tags, recipients, counts = await main.write(write)
+    main.feed_cache.invalidate(tags)
+    main.events.publish(
+        "reaction_changed", {"id": post_id, "reactions": counts}, tags, recipients
+    )
     return {}
 
 
@@ -28,10 +104,101 @@ async def add_reaction(
 async def remove_reaction(
     request: Request, session: Session, post_id: int, emoji: int
 ) -> RESPONSE:
-    con, cur = main.db()
-    cur.execute(
-        "DELETE FROM reaction WHERE emoji = ? AND post_id = ? and user_id = ?",
-        [emoji, post_id, session.user_id],
+
+    def write(
+        cur: sqlite3.Cursor,
+    ) -> tuple[list[str], list[str], dict[int, int]] | None:
+        cur.execute(
+            "DELETE FROM reaction WHERE emoji = ? AND post_id = ? and user_id = ?",
+            [emoji, post_id, session.user_id],
+        )
+        if cur.rowcount == 0:
+            # Nothing changed, so neither do the post's versions.
+            return None
+        count_reaction(cur, post_id, emoji, -1)
+        touch_post(cur, post_id)
+        tags = get_post_tags(cur, post_id)
+        touch_tags(cur, tags)
+        return (
+            tags,
+            get_post_recipients(cur, post_id),
+            get_reaction_counts(cur, [post_id]).get(post_id, {}),
+        )
+
+    removed = await main.write(write)
+    if removed is None:
+        return {}
+    tags, recipients, counts = removed
+    main.feed_cache.invalidate(tags)
+    main.events.publish(
+        "reaction_changed", {"id": post_id, "reactions": counts}, tags, recipients
     )
-    con.commit()
+    return {}
+
+
+class ReactionChange(Model):
+    post_id: int
+    emoji: int
+    on: bool
+
+
+@main.POST("/api/set_reactions")
+async def set_reactions(
+    request: Request, session: Session, changes: list[ReactionChange]
+) -> RESPONSE:
+    """Add (`on`) or remove reactions in bulk, in a single transaction.
+
+    Changes to the same reaction are applied in order, so the last one wins. Unlike
+    /api/add_reaction, adding an existing reaction is not an error, but like it
+    adding one to a post the session can't see fails every change. Concurrent
+    requests share a commit through `Main.write`.
+    """
+    if len(changes) > SET_REACTIONS_MAX:
+        raise Error(f"At most {SET_REACTIONS_MAX} reactions can be set at once.")
+    # Only the last change to each reaction matters.
+    final = {(change.post_id, change.emoji): change.on for change in changes}
+
+    def write(
+        cur: sqlite3.Cursor,
+    ) -> dict[int, tuple[list[str], list[str], dict[int, int]]]:
+        # Removing is allowed anywhere, like /api/remove_reaction.
+        check_visible(
+            cur, session, [post_id for (post_id, _), on in final.items() if on]
+        )
+        cur.executemany(
+            "INSERT OR IGNORE INTO reaction (emoji, post_id, user_id) VALUES (?, ?, ?)",
+            [
+                (emoji, post_id, session.user_id)
+                for (post_id, emoji), on in final.items()
+                if on
+            ],
+        )
+        cur.executemany(
+            "DELETE FROM reaction WHERE emoji = ? AND post_id = ? AND user_id = ?",
+            [
+                (emoji, post_id, session.user_id)
+                for (post_id, emoji), on in final.items()
+                if not on
+            ],
+        )
+        recount_reactions(cur, list(final))
+        post_ids = list({post_id for post_id, _ in final})
+        counts = get_reaction_counts(cur, post_ids)
+        posts: dict[int, tuple[list[str], list[str], dict[int, int]]] = {}
+        for post_id in post_ids:
+            touch_post(cur, post_id)
+            tags = get_post_tags(cur, post_id)
+            touch_tags(cur, tags)
+            posts[post_id] = (
+                tags,
+                get_post_recipients(cur, post_id),
+                counts.get(post_id, {}),
+            )
+        return posts
+
+    for post_id, (tags, recipients, counts) in (await main.write(write)).items():
+        main.feed_cache.invalidate(tags)
+        main.events.publish(
+            "reaction_changed", {"id": post_id, "reactions": counts}, tags, recipients
+        )
     return {}
@@ -0,0 +1,76 @@
+import json
+import sqlite3
+
+from starlette.requests import Request
+
+from . import main
+from .misc import RESPONSE, Error
+from .post import add_user_reactions, read_posts
+from .session import Session
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGE_SIZE_MAX = 100
+
+
+def match_expression(query: str) -> str:
+    """Turn a search box query into an FTS5 expression matching posts which contain
+    every word of it, so the user can't write a malformed one."""
+    return " ".join('"' + word.replace('"', '""') + '"' for word in query.split())
+
+
+@main.GET("/api/search_posts")
+async def search_posts(
+    request: Request,
+    session: Session,
+    query: str,
+    offset: int | None,
+    limit: int | None,
+) -> RESPONSE:
+    """Return one page of the posts the session can see which contain every word of
+    `query`, best match first.
+
+    Pass the returned `next` as `offset` to fetch the following page, `next` is
+    `None` once there are no more results.
+    """
+    if query.strip() == "":
+        raise Error("Search query is empty.")
+    offset = max(offset or 0, 0)
+    limit = min(max(limit or SEARCH_PAGE_SIZE, 1), SEARCH_PAGE_SIZE_MAX)
+
+    def read(cur: sqlite3.Cursor) -> list[int]:
+        return [
+            row["rowid"]
+            for row in cur.execute(
+                """SELECT rowid FROM post_search
+                   WHERE post_search MATCH ?
+                   AND (
+                       rowid IN (
+                           SELECT post_id FROM post_tag
+                           WHERE tag IN (SELECT value FROM json_each(?))
+                       )
+                       OR rowid IN (
+                           SELECT post_id FROM post_recipient WHERE username = ?
+                       )
+                   )
+                   ORDER BY rank
+                   LIMIT ? OFFSET ?""",
+                [
+                    match_expression(query),
+                    json.dumps(session.tags),
+                    session.username,
+                    limit,
+                    offset,
+                ],
+            )
+        ]
+
+    ids = await main.read(read)
+    posts = await read_posts(
+        "SELECT value AS post_id FROM json_each(?)", [json.dumps(ids)], len(ids)
+    )
+    rank = {id: i for i, id in enumerate(ids)}
+    posts.sort(key=lambda post: rank[post["id"]])
+    return {
+        "posts": await add_user_reactions(session, posts),
+        "next": offset + limit if len(ids) == limit else None,
+    }
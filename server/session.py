@@ -1,11 +1,18 @@
+import asyncio
 import hashlib
+import hmac
+import heapq
 import json
 import secrets
-from dataclasses import dataclass
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from dataclasses import dataclass, field
 from typing import TYPE_CHECKING
 
 from starlette.requests import Request
 
+from .metrics import request_stats
 from .misc import Error
 
 if TYPE_CHECKING:
@@ -20,30 +27,253 @@ def is_password_valid(password: str) -> bool:
     return 8 <= len(password)
 
 
-def hash_password(password: str, username: str) -> str:
-    return hashlib.sha256((password + username).encode()).hexdigest()
+# The KDF used for new password hashes and its parameters. Hashes made with anything
+# else are upgraded the next time their owner logs in.
+PASSWORD_KDF = "scrypt"
+PASSWORD_KDF_PARAMS = {
+    "scrypt": "16384,8,1",  # n, r, p
+    "pbkdf2_sha256": "600000",  # iterations
+}
 
 
-@dataclass
+def derive_key(kdf: str, params: str, password: str, salt: bytes) -> bytes:
+    if kdf == "scrypt":
+        n, r, p = map(int, params.split(","))
+        return hashlib.scrypt(password.encode(), salt=salt, n=n, r=r, p=p)
+    if kdf == "pbkdf2_sha256":
+        return hashlib.pbkdf2_hmac("sha256", password.encode(), salt, int(params))
+    raise ValueError(f"Unknown KDF {kdf}")
+
+
+def hash_password(password: str) -> str:
+    """Hash a password as `kdf$params$salt$key` with a fresh random salt."""
+    params = PASSWORD_KDF_PARAMS[PASSWORD_KDF]
+    salt = secrets.token_bytes(16)
+    key = derive_key(PASSWORD_KDF, params, password, salt)
+    return f"{PASSWORD_KDF}${params}${salt.hex()}${key.hex()}"
+
+
+def verify_password(password: str, username: str, password_hash: str) -> bool:
+    if "$" not in password_hash:
+        # Legacy unsalted hash.
+        legacy = hashlib.sha256((password + username).encode()).hexdigest()
+        return hmac.compare_digest(legacy, password_hash)
+    kdf, params, salt, key = password_hash.split("$")
+    return hmac.compare_digest(
+        derive_key(kdf, params, password, bytes.fromhex(salt)).hex(), key
+    )
+
+
+def password_needs_rehash(password_hash: str) -> bool:
+    return not password_hash.startswith(
+        f"{PASSWORD_KDF}${PASSWORD_KDF_PARAMS[PASSWORD_KDF]}$"
+    )
+
+
+# Sessions end this many seconds after login, or after going unused for
+# SESSION_IDLE_TIMEOUT seconds, whichever comes first.
+SESSION_TTL = 30 * 24 * 60 * 60
+SESSION_IDLE_TIMEOUT = 7 * 24 * 60 * 60
+SESSION_SWEEP_INTERVAL = 60
+
+
+@dataclass(slots=True)
 class Session:
     token: str
     user_id: int
     username: str
     permission: int
     tags: list[str]
+    created_time: float = field(default_factory=time.time)
+    last_used_time: float = field(default_factory=time.time)
 
+    @property
+    def expires_time(self) -> float:
+        return min(
+            self.created_time + SESSION_TTL, self.last_used_time + SESSION_IDLE_TIMEOUT
+        )
 
-class Sessions:
-    def __init__(self, main: "Main") -> None:
+
+class SessionBackend(ABC):
+    """Where sessions are kept."""
+
+    @abstractmethod
+    async def get(self, token: str) -> Session | None: ...
+
+    @abstractmethod
+    async def add(self, session: Session) -> None: ...
+
+    @abstractmethod
+    async def remove(self, token: str) -> None: ...
+
+    @abstractmethod
+    async def remove_user(self, user_id: int) -> None:
+        """Remove every session of a user."""
+
+    @abstractmethod
+    def invalidate_user(self, user_id: int) -> None:
+        """Drop any cached copies of a user's sessions after the user changed."""
+
+    @abstractmethod
+    async def sweep(self, now: float) -> None:
+        """Remove sessions which expired before `now`."""
+
+
+class MemorySessionBackend(SessionBackend):
+    """Keeps sessions in a process-local dict, they are lost on restart."""
+
+    def __init__(self) -> None:
         self.sessions: dict[str, Session] = {}
+        self.user_tokens: dict[int, set[str]] = {}
+        # Heap of (expires_time, token). An entry may be stale if the session was
+        # used or removed since it was pushed, `sweep` checks before reaping.
+        self.deadlines: list[tuple[float, str]] = []
+
+    async def get(self, token: str) -> Session | None:
+        return self.sessions.get(token)
+
+    async def add(self, session: Session) -> None:
+        self.sessions[session.token] = session
+        self.user_tokens.setdefault(session.user_id, set()).add(session.token)
+        heapq.heappush(self.deadlines, (session.expires_time, session.token))
+
+    async def remove(self, token: str) -> None:
+        session = self.sessions.pop(token, None)
+        if session is None:
+            return
+        tokens = self.user_tokens[session.user_id]
+        tokens.discard(token)
+        if not tokens:
+            del self.user_tokens[session.user_id]
+
+    async def remove_user(self, user_id: int) -> None:
+        for token in self.user_tokens.pop(user_id, ()):
+            del self.sessions[token]
+
+    def invalidate_user(self, user_id: int) -> None:
+        pass
+
+    async def sweep(self, now: float) -> None:
+        while self.deadlines and self.deadlines[0][0] <= now:
+            _, token = heapq.heappop(self.deadlines)
+            session = self.sessions.get(token)
+            if session is None:
+                continue
+            if session.expires_time <= now:
+                await self.remove(token)
+            else:
+                heapq.heappush(self.deadlines, (session.expires_time, token))
+
+
+class SQLiteSessionBackend(SessionBackend):
+    """Keeps sessions in the `session` table, so they are shared between workers and
+    survive restarts.
+
+    Reads go through an LRU cache of at most `cache_size` sessions. Cached sessions
+    are refetched after `cache_ttl` seconds, which bounds how long a change made by
+    another worker can go unnoticed.
+    """
+
+    def __init__(
+        self, main: "Main", cache_size: int = 65536, cache_ttl: float = 10
+    ) -> None:
         self.main = main
+        self.cache_size = cache_size
+        self.cache_ttl = cache_ttl
+        self.cache: OrderedDict[str, tuple[Session, float]] = OrderedDict()
+        self.user_tokens: dict[int, set[str]] = {}
+
+    def cache_put(self, session: Session) -> None:
+        self.cache[session.token] = (session, time.monotonic() + self.cache_ttl)
+        self.cache.move_to_end(session.token)
+        self.user_tokens.setdefault(session.user_id, set()).add(session.token)
+        if len(self.cache) > self.cache_size:
+            self.cache_pop(next(iter(self.cache)))
 
-    def get_session(self, request: Request) -> Session | None:
-        return self.sessions.get(request.cookies.get("token", ""))
+    def cache_pop(self, token: str) -> None:
+        cached = self.cache.pop(token, None)
+        if cached is None:
+            return
+        tokens = self.user_tokens[cached[0].user_id]
+        tokens.discard(token)
+        if not tokens:
+            del self.user_tokens[cached[0].user_id]
+
+    async def get(self, token: str) -> Session | None:
+        cached = self.cache.get(token)
+        if cached is not None and cached[1] > time.monotonic():
+            self.cache.move_to_end(token)
+            return cached[0]
+        row = await self.main.fetchone(
+            """SELECT u.id, u.username, u.permission, u.tags, s.created_time
+               FROM session s, user u
+               WHERE s.token = ? AND u.id = s.user_id AND u.deleted_time IS NULL""",
+            [token],
+        )
+        if row is None:
+            self.cache_pop(token)
+            return None
+        session = Session(
+            token,
+            row["id"],
+            row["username"],
+            row["permission"],
+            json.loads(row["tags"]),
+            row["created_time"],
+            cached[0].last_used_time if cached is not None else time.time(),
+        )
+        self.cache_put(session)
+        return session
+
+    async def add(self, session: Session) -> None:
+        await self.main.execute(
+            "INSERT INTO session (token, user_id, created_time) VALUES (?, ?, ?)",
+            [session.token, session.user_id, session.created_time],
+        )
+        self.cache_put(session)
 
-    def new_session(self, username: str, password: str) -> Session:
-        row = self.main.db_fetchone(
-            "SELECT password_hash, permission, id, tags FROM user WHERE username = ?",
+    async def remove(self, token: str) -> None:
+        self.cache_pop(token)
+        await self.main.execute("DELETE FROM session WHERE token = ?", [token])
+
+    async def remove_user(self, user_id: int) -> None:
+        self.invalidate_user(user_id)
+        await self.main.execute("DELETE FROM session WHERE user_id = ?", [user_id])
+
+    def invalidate_user(self, user_id: int) -> None:
+        for token in self.user_tokens.pop(user_id, ()):
+            del self.cache[token]
+
+    async def sweep(self, now: float) -> None:
+        # Idle time is only tracked per process, expired rows are reaped by age.
+        await self.main.execute(
+            "DELETE FROM session WHERE created_time <= ?", [now - SESSION_TTL]
+        )
+
+
+class Sessions:
+    def __init__(self, main: "Main", backend: SessionBackend | None = None) -> None:
+        self.backend = backend or MemorySessionBackend()
+        self.main = main
+
+    async def get_session(self, request: Request) -> Session | None:
+        session = await self.backend.get(request.cookies.get("token", ""))
+        if session is None:
+            return None
+        now = time.time()
+        if session.expires_time <= now:
+            await self.backend.remove(session.token)
+            return None
+        session.last_used_time = now
+        stats = request_stats.get()
+        if stats is not None:
+            stats.user_id = session.user_id
+        return session
+
+    async def new_session(self, username: str, password: str) -> Session:
+        row = await self.main.fetchone(
+            """SELECT password_hash, permission, id, tags FROM user
+               WHERE username = ? AND deleted_time IS NULL""",
             [username],
         )
         if row is None:
@@ -52,24 +282,39 @@ class Sessions:
         permission: int = row["permission"]
         user_id: int = row["id"]
         tags: list[str] = json.loads(row["tags"])
-        if hash_password(password, username) != password_hash:
+        if not await self.main.kdf(verify_password, password, username, password_hash):
             raise Error("Password is incorrect.")
-        token = secrets.token_urlsafe()
-        self.sessions[token] = Session(token, user_id, username, permission, tags)
-        return self.sessions[token]
+        if password_needs_rehash(password_hash):
+            await self.main.execute(
+                "UPDATE user SET password_hash = ? WHERE id = ? AND password_hash = ?",
+                [await self.main.kdf(hash_password, password), user_id, password_hash],
+            )
+        session = Session(secrets.token_urlsafe(), user_id, username, permission, tags)
+        await self.backend.add(session)
+        return session
 
-    def remove_session(self, session_or_token: Session | str) -> None:
-        self.sessions.pop(
-            session_or_token.token
+    async def remove_session(self, session_or_token: Session | str) -> None:
+        """Remove a session and end its event streams."""
+        session = (
+            session_or_token
             if isinstance(session_or_token, Session)
-            else session_or_token,
-            None,
+            else await self.backend.get(session_or_token)
         )
+        if session is None:
+            return
+        await self.backend.remove(session.token)
+        self.main.events.close(session.user_id, session.token)
+
+    async def remove_all_sessions(self, user_id: int) -> None:
+        """Remove every session of a user and end their event streams."""
+        await self.backend.remove_user(user_id)
+        self.main.events.close(user_id)
+
+    def invalidate_user(self, user_id: int) -> None:
+        self.backend.invalidate_user(user_id)
 
-    def remove_all_sessions(self, username: str) -> None:
-        for session in [
-            session
-            for session in self.sessions.values()
-            if session.username == username
-        ]:
-            self.remove_session(session)
+    async def sweeper(self) -> None:
+        """Periodically reap expired sessions, runs for the lifetime of the app."""
+        while True:
+            await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+            await self.backend.sweep(time.time())
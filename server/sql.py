@@ -6,5 +6,4 @@ def update(
 ) -> tuple[str, list[Any]]:
     d = {name: value for name, value in set.items() if value is not None}
     query = f"UPDATE {TABLE} SET {', '.join(i+' = ?' for i in d)} WHERE {where}"
-    print(query)
     return query, [*d.values(), *args]
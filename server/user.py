@@ -1,20 +1,30 @@
 import json
+import sqlite3
 
 from starlette.requests import Request
 
 from . import main, sql
+from .deletion import start_deletion
+from .inbox import rebuild_inbox
 from .misc import RESPONSE, Error
-from .session import Session, hash_password, is_password_valid, is_username_valid
+from .session import (
+    Session,
+    hash_password,
+    is_password_valid,
+    is_username_valid,
+    verify_password,
+)
+from .versions import next_version, touch_author_tags
 
 
 @main.POST("/api/login", require_logged_in=False)
 async def login(request: Request, username: str, password: str) -> RESPONSE:
-    return {"token": main.sessions.new_session(username, password).token}
+    return {"token": (await main.sessions.new_session(username, password)).token}
 
 
 @main.POST("/api/logout")
 async def logout(request: Request, session: Session) -> RESPONSE:
-    main.sessions.remove_session(session)
+    await main.sessions.remove_session(session)
     return {}
 
 
@@ -26,16 +36,26 @@ async def register(
         raise Error("Username is invalid.")
     if not is_password_valid(password):
         raise Error("Password is invalid.")
-    con, cur = main.db()
-    row = cur.execute("SELECT id FROM user WHERE username = ?", [username]).fetchone()
-    if row is not None:
+    if await main.fetchone("SELECT id FROM user WHERE username = ?", [username]):
         raise Error("Username already exists.")
-    cur.execute(
-        "INSERT INTO user (username, display_name, password_hash) VALUES (?, ?, ?)",
-        [username, display_name, hash_password(password, username)],
-    )
-    con.commit()
-    return {"id": cur.lastrowid}
+    password_hash = await main.kdf(hash_password, password)
+
+    def write(cur: sqlite3.Cursor) -> int:
+        row = cur.execute(
+            "SELECT id FROM user WHERE username = ?", [username]
+        ).fetchone()
+        if row is not None:
+            raise Error("Username already exists.")
+        cur.execute(
+            "INSERT INTO user (username, display_name, password_hash) VALUES (?, ?, ?)",
+            [username, display_name, password_hash],
+        )
+        id: int = cur.lastrowid  # type: ignore
+        if main.fanout:
+            rebuild_inbox(cur, id)
+        return id
+
+    return {"id": await main.write(write)}
 
 
 @main.POST("/api/change_password", require_logged_in=False)
@@ -44,21 +64,21 @@ async def change_password(
 ) -> RESPONSE:
     if not is_password_valid(new_password):
         raise Error("New password is invalid.")
-    con, cur = main.db()
-    row = cur.execute(
-        "SELECT password_hash FROM user WHERE username = ?", [username]
-    ).fetchone()
+    row = await main.fetchone(
+        """SELECT id, password_hash FROM user
+           WHERE username = ? AND deleted_time IS NULL""",
+        [username],
+    )
     if row is None:
         raise Error("Username not found.")
     password_hash: str = row["password_hash"]
-    if hash_password(old_password, username) != password_hash:
+    if not await main.kdf(verify_password, old_password, username, password_hash):
         raise Error("Old password is incorrect.")
-    cur.execute(
+    await main.execute(
         "UPDATE user SET password_hash = ? WHERE username = ?",
-        [hash_password(new_password, username), username],
+        [await main.kdf(hash_password, new_password), username],
     )
-    con.commit()
-    main.sessions.remove_all_sessions(username)
+    await main.sessions.remove_all_sessions(row["id"])
     return {}
 
 
@@ -72,20 +92,34 @@ async def edit_profile(
 ) -> RESPONSE:
     if tags is not None:
         session.tags = tags
-    con, cur = main.db()
-    cur.execute(
-        *sql.update(
-            "user",
-            set={
-                "display_name": display_name,
-                "avatar_url": avatar_url,
-                "tags": json.dumps(tags) if tags is not None else None,
-            },
-            where="id = ?",
-            args=[session.user_id],
+
+    def write(cur: sqlite3.Cursor) -> list[str]:
+        cur.execute(
+            *sql.update(
+                "user",
+                set={
+                    "display_name": display_name,
+                    "avatar_url": avatar_url,
+                    "tags": json.dumps(tags) if tags is not None else None,
+                },
+                where="id = ?",
+                args=[session.user_id],
+            )
         )
-    )
-    con.commit()
+        if main.fanout and tags is not None:
+            rebuild_inbox(cur, session.user_id)
+        cur.execute(
+            "UPDATE post SET version = ? WHERE author_id = ?",
+            [next_version(cur), session.user_id],
+        )
+        return touch_author_tags(cur, session.user_id)
+
+    author_tags = await main.write(write)
+    main.sessions.invalidate_user(session.user_id)
+    if tags is not None:
+        main.events.update_tags(session.username, tags)
+    # Cached posts embed their author's profile.
+    main.feed_cache.invalidate(author_tags)
     return {}
 
 
@@ -96,9 +130,9 @@ async def check_session(request: Request, session: Session) -> RESPONSE:
 
 @main.GET("/api/get_user")
 async def get_user(request: Request, session: Session, username: str) -> RESPONSE:
-    row = main.db_fetchone(
+    row = await main.fetchone(
         """SELECT id, display_name, avatar_url, tags, permission, created_time FROM user
-           WHERE username = ?""",
+           WHERE username = ? AND deleted_time IS NULL""",
         [username],
     )
     if row is None:
@@ -120,19 +154,20 @@ async def delete_user(
     username: str,
     password: str,
 ) -> RESPONSE:
-    con, cur = main.db()
-    row = cur.execute(
-        "SELECT id, password_hash FROM user WHERE username = ?", [username]
-    ).fetchone()
+    """Delete a user and everything they made. The user is gone at once, the rest is
+    removed in the background, follow it with /api/get_deletion and the returned
+    `token`."""
+    row = await main.fetchone(
+        """SELECT id, password_hash FROM user
+           WHERE username = ? AND deleted_time IS NULL""",
+        [username],
+    )
     if row is None:
         raise Error("Username not found.")
-    id: str = row["id"]
+    id: int = row["id"]
     password_hash: str = row["password_hash"]
-    if hash_password(password, username) != password_hash:
+    if not await main.kdf(verify_password, password, username, password_hash):
         raise Error("Password is incorrect.")
-    cur.execute("DELETE FROM user WHERE id = ?", [id])
-    cur.execute("DELETE FROM post WHERE author_id = ?", [id])
-    cur.execute("DELETE FROM reaction WHERE user_id = ?", [id])
-    con.commit()
-    main.sessions.remove_all_sessions(username)
-    return {}
+    token = await start_deletion(id)
+    await main.sessions.remove_all_sessions(id)
+    return {"token": token}
@@ -0,0 +1,64 @@
+"""Versions used to answer conditional GETs without building the response.
+
+Every write that changes what a feed shows takes the next value of the global change
+sequence. Posts store the value of the last write that changed them, including
+reactions and edits to their author's profile, in `post.version`.
+
+Those writes also bump the version of each tag whose posts they change, kept in
+`tag_version`, which the feed cache checks so it sees writes made by other workers.
+"""
+
+import hashlib
+import json
+import sqlite3
+from typing import Any
+
+
+def next_version(cur: sqlite3.Cursor) -> int:
+    return cur.execute(
+        "UPDATE change_sequence SET value = value + 1 RETURNING value"
+    ).fetchone()[0]
+
+
+def touch_post(cur: sqlite3.Cursor, post_id: int) -> None:
+    cur.execute(
+        "UPDATE post SET version = ? WHERE id = ?", [next_version(cur), post_id]
+    )
+
+
+def touch_tags(cur: sqlite3.Cursor, tags: list[str]) -> None:
+    cur.executemany(
+        """INSERT INTO tag_version (tag, value) VALUES (?, 1)
+           ON CONFLICT (tag) DO UPDATE SET value = value + 1""",
+        [(tag,) for tag in set(tags)],
+    )
+
+
+def touch_author_tags(cur: sqlite3.Cursor, user_id: int) -> list[str]:
+    """Bump the version of every tag a user has posted in, and return those tags."""
+    tags = [
+        row["tag"]
+        for row in cur.execute(
+            """SELECT DISTINCT t.tag FROM post p, post_tag t
+               WHERE p.author_id = ? AND t.post_id = p.id""",
+            [user_id],
+        )
+    ]
+    touch_tags(cur, tags)
+    return tags
+
+
+def get_tag_versions(cur: sqlite3.Cursor, tags: tuple[str, ...]) -> tuple[int, ...]:
+    versions = {
+        row["tag"]: row["value"]
+        for row in cur.execute(
+            """SELECT tag, value FROM tag_version
+               WHERE tag IN (SELECT value FROM json_each(?))""",
+            [json.dumps(tags)],
+        )
+    }
+    return tuple(versions.get(tag, 0) for tag in tags)
+
+
+def make_etag(*parts: Any) -> str:
+    return hashlib.blake2b(repr(parts).encode(), digest_size=12).hexdigest()